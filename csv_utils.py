@@ -1,11 +1,14 @@
-import os, csv, io
+import os, csv, io, re
+from itertools import islice
 from qgis.core import QgsMessageLog
 from qgis.utils import iface
 from qgis.core import Qgis as QGis
 
-from qgis.PyQt.QtCore import QDateTime
+from qgis.PyQt.QtCore import Qt, QDateTime
 from qgis.PyQt.QtWidgets import QFileDialog
 
+import numpy as np
+
 labels = {'ID': 'id', 'X': 'lon', 'Y': 'lat', 'AZIMUT': 'azi'}
 
 types = {
@@ -17,6 +20,265 @@ types = {
 
 tableHeaders = ['id', 'datetime', 'lat', 'lon', 'azi']
 
+# Number of lines read at once when streaming a csv file
+CHUNK_SIZE = 5000
+
+# Supported datetime formats, the first one being the default
+DATETIME_FORMATS = ['yyyy-MM-dd hh:mm:ss', 'd/M/yyyy hh:mm:ss',
+                    'M/d/yyyy hh:mm:ss', 'hh:mm:ss d/M/yyyy',
+                    'hh:mm:ss M/d/yyyy']
+
+# Number of datetimes used for detecting their format
+DATETIME_SAMPLE_SIZE = 100
+
+def dateTimeToEpoch(datetime):
+    """Convert a QDateTime into seconds, ignoring its time zone
+
+    The datetimes read from the files have no time zone, so they are
+    stored as if they were expressed in UTC.
+    """
+    return QDateTime(datetime.date(), datetime.time(),
+                     Qt.UTC).toSecsSinceEpoch()
+
+def epochToDateTime(epoch):
+    """Convert seconds built by dateTimeToEpoch back into a local QDateTime"""
+    datetime = QDateTime.fromSecsSinceEpoch(int(epoch), Qt.UTC)
+    return QDateTime(datetime.date(), datetime.time())
+
+# Field of each section of the supported datetime formats, with the
+# regular expression of its text (ASCII digits only, like QDateTime)
+DATETIME_SECTIONS = {
+    'yyyy': ('year', r'[0-9]{4}'),
+    'yy': ('year2', r'[0-9]{2}'),
+    'MM': ('month', r'[0-9]{2}'),
+    'M': ('month', r'[0-9]{1,2}'),
+    'dd': ('day', r'[0-9]{2}'),
+    'd': ('day', r'[0-9]{1,2}'),
+    'HH': ('hour', r'[0-9]{2}'),
+    'H': ('hour', r'[0-9]{1,2}'),
+    'hh': ('hour', r'[0-9]{2}'),
+    'h': ('hour', r'[0-9]{1,2}'),
+    'mm': ('minute', r'[0-9]{2}'),
+    'm': ('minute', r'[0-9]{1,2}'),
+    'ss': ('second', r'[0-9]{2}'),
+    's': ('second', r'[0-9]{1,2}'),
+}
+
+DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def daysFromCivil(years, months, days):
+    """Number of days since 1970-01-01 of dates of the Gregorian calendar
+    (see http://howardhinnant.github.io/date_algorithms.html)"""
+    years = years - (months <= 2)
+    eras = years // 400
+    yearsOfEra = years - eras * 400
+    daysOfYear = (153 * np.where(months > 2, months - 3, months + 9) + 2) // 5 + \
+        days - 1
+    daysOfEra = yearsOfEra * 365 + yearsOfEra // 4 - yearsOfEra // 100 + \
+        daysOfYear
+    return eras * 146097 + daysOfEra - 719468
+
+class DateTimeParser:
+    """Parser of many datetime texts at once
+
+    The Qt format is translated once into a regular expression, which
+    is applied to all the texts in a single pass. The fields are then
+    checked and converted into epoch seconds (see dateTimeToEpoch) with
+    NumPy. Formats with other sections than the numeric ones of
+    DATETIME_SECTIONS are parsed with QDateTime, one text at a time.
+
+    Parameters
+    ----------
+    datetimeFormat : str
+        Qt format of the datetimes
+    """
+
+    def __init__(self, datetimeFormat):
+        self.datetimeFormat = datetimeFormat
+        self.fields = []
+        self.regex = None
+        pattern = ''
+        for match in re.finditer(r"([A-Za-z])\1*|'|[^A-Za-z']+",
+                                 datetimeFormat):
+            token = match.group(0)
+            if token[0].isalpha():
+                section = DATETIME_SECTIONS.get(token)
+                if section is None or section[0] in self.fields:
+                    # Unsupported format
+                    return
+                self.fields.append(section[0])
+                pattern += '(' + section[1] + ')'
+            elif token == "'":
+                return
+            else:
+                pattern += re.escape(token)
+        # Invalid lines match the second alternative with empty fields
+        self.regex = re.compile('^(?:' + pattern + '$)?.*$', re.MULTILINE)
+
+    def parse(self, contents):
+        """Convert texts into epoch seconds
+
+        Parameters
+        ----------
+        contents : list of str
+
+        Returns
+        -------
+        epochs : numpy.ndarray of int64
+            The datetime of each text in seconds (0 when invalid)
+        valid : numpy.ndarray of bool
+            Mask of the valid datetimes
+        """
+        nbContents = len(contents)
+        epochs = np.zeros(nbContents, dtype = np.int64)
+        valid = np.zeros(nbContents, dtype = bool)
+        if nbContents == 0:
+            return epochs, valid
+        matches = None
+        if self.regex is not None and \
+           all(isinstance(content, str) for content in contents):
+            matches = self.regex.findall('\n'.join(contents))
+            if len(self.fields) == 1:
+                matches = [(match,) for match in matches]
+        # Texts with line breaks do not give one match each
+        if matches is None or len(matches) != nbContents:
+            for i, content in enumerate(contents):
+                if not isinstance(content, QDateTime):
+                    content = QDateTime.fromString(str(content),
+                                                   self.datetimeFormat)
+                if content.isValid():
+                    epochs[i] = dateTimeToEpoch(content)
+                    valid[i] = True
+            return epochs, valid
+
+        texts = np.array(matches, dtype = str).reshape(nbContents, -1)
+        valid[:] = texts[:, 0] != ''
+        texts[~valid] = '0'
+        values = {field: texts[:, i].astype(np.int64)
+                  for i, field in enumerate(self.fields)}
+        zeros = np.zeros(nbContents, dtype = np.int64)
+        years = values.get('year', 1900 + values.get('year2', zeros))
+        # Missing sections have the same default as with QDateTime
+        months = values.get('month', zeros + 1)
+        days = values.get('day', zeros + 1)
+        hours = values.get('hour', zeros)
+        minutes = values.get('minute', zeros)
+        seconds = values.get('second', zeros)
+        leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+        monthOk = (months >= 1) & (months <= 12)
+        daysInMonth = DAYS_IN_MONTH[np.where(monthOk, months, 1) - 1] + \
+            (leap & (months == 2))
+        valid &= monthOk & (days >= 1) & (days <= daysInMonth) & \
+            (hours <= 23) & (minutes <= 59) & (seconds <= 59)
+        epochs[:] = np.where(valid, daysFromCivil(years, months, days) *
+                             86400 + hours * 3600 + minutes * 60 + seconds, 0)
+        # Like QDateTime, reject the local times that do not exist
+        valid &= ~localTimeGaps(epochs, valid)
+        epochs[~valid] = 0
+        return epochs, valid
+
+def localTimeGaps(epochs, valid):
+    """Mask of the datetimes (see dateTimeToEpoch) skipped by the local
+    time zone, like the hour lost when the daylight saving time starts
+
+    Only the days whose offset from UTC changes are checked one
+    datetime at a time.
+    """
+    gaps = np.zeros(len(epochs), dtype = bool)
+    days = epochs // 86400
+    for day in np.unique(days[valid]).tolist():
+        start = epochToDateTime(day * 86400)
+        end = epochToDateTime((day + 1) * 86400)
+        if start.isValid() and end.isValid() and \
+           start.offsetFromUtc() == end.offsetFromUtc():
+            continue
+        for i in np.flatnonzero(valid & (days == day)).tolist():
+            gaps[i] = not epochToDateTime(epochs[i]).isValid()
+    return gaps
+
+def detectDateTimeFormat(contents, datetimeFormat):
+    """Find the supported format that parses the most datetimes
+
+    Parameters
+    ----------
+    contents : list of str
+        A sample of datetime texts (the empty ones are ignored)
+    datetimeFormat : str
+        The current format, kept when no other format is better
+
+    Return
+    ------
+    datetimeFormat : str
+        The format with the best parse rate on the sample
+    """
+    contents = [content for content in contents if content != '']
+    contents = contents[:DATETIME_SAMPLE_SIZE]
+    bestFormat = datetimeFormat
+    bestCount = DateTimeParser(datetimeFormat).parse(contents)[1].sum()
+    for candidate in DATETIME_FORMATS:
+        count = DateTimeParser(candidate).parse(contents)[1].sum()
+        if count > bestCount:
+            bestFormat, bestCount = candidate, count
+    return bestFormat
+
+class Schema:
+    """Layout of the columns of a loaded table
+
+    The position of each known column and the parser of each column
+    are resolved once, when the headers are read, so that no header
+    lookup is needed when processing rows. Additional columns and any
+    column order are supported.
+
+    Parameters
+    ----------
+    headers : list of str
+        Name of each column of the table
+    datetimeFormat : str
+        Format used for parsing the datetime column
+    """
+
+    def __init__(self, headers, datetimeFormat):
+        self.headers = list(headers)
+        self.positions = {}
+        for col, header in enumerate(self.headers):
+            self.positions.setdefault(header, col)
+        self.types = [types.get(header, str) for header in self.headers]
+        self.idIndex = self.position(labels['ID'])
+        self.dateIndex = self.position('datetime')
+        self.latIndex = self.position(labels['Y'])
+        self.lonIndex = self.position(labels['X'])
+        self.aziIndex = self.position(labels['AZIMUT'])
+        self.setDateTimeFormat(datetimeFormat)
+
+    def position(self, header):
+        """Column of a header, or None when it is absent"""
+        return self.positions.get(header)
+
+    def setDateTimeFormat(self, datetimeFormat):
+        """Compile the parser of each column for the given datetime format"""
+        self.datetimeFormat = datetimeFormat
+        self.dateTimeParser = DateTimeParser(datetimeFormat)
+        self.parsers = [self.compileParser(parseType)
+                        for parseType in self.types]
+
+    def compileParser(self, parseType):
+        """Build a function converting a text (or an already typed value)
+        into the value stored for a column. It raises a ValueError when
+        the conversion fails."""
+        if parseType != QDateTime:
+            return parseType
+        dateTimeParser = self.dateTimeParser
+        def parseDateTime(content):
+            if isinstance(content, QDateTime):
+                if not content.isValid():
+                    raise ValueError('Invalid datetime')
+                return dateTimeToEpoch(content)
+            epochs, valid = dateTimeParser.parse([content])
+            if not valid[0]:
+                raise ValueError('Invalid datetime')
+            return int(epochs[0])
+        return parseDateTime
+
 def writeCsv(csvFileName, array):
     try:
         with io.open(csvFileName, 'w', newline = '') as outputFile:
@@ -52,7 +314,8 @@ def validateHeaders(headers):
     Parameters
     ----------
     headers : list of str
-        First line of the csv file. Each column name must be in this array
+        First line of the csv file. Each column name of tableHeaders
+        must be in this array, in any order
 
     Returns
     -------
@@ -61,12 +324,9 @@ def validateHeaders(headers):
     """
 
     errors = []
-    try:
-        for index, header in enumerate(tableHeaders):
-            if header != headers[index]:
-                errors.append('Field ' + headers[index] + ' should be ' + header)
-    except:
-        errors.append('Missing header field(s)')
+    for header in tableHeaders:
+        if header not in headers:
+            errors.append('Missing header field ' + header)
 
     if len(errors) > 0:
         iface.messageBar().pushCritical('Error Radiotrack', 'Header structure error. Check the log.')
@@ -75,39 +335,50 @@ def validateHeaders(headers):
 
     return len(errors) == 0
 
-def loadCsvToArray(filename):
-    """Load the content of the given csv file into an array
+def readCsvChunks(filename, chunkSize = CHUNK_SIZE, progress = None):
+    """Read the given csv file by chunks of lines
 
-    The resulting array will contain each line of the csv file
-    A line of the csv file is an array of strings
+    The headers are read and validated once. The file is then read
+    lazily, so that only one chunk of lines is in memory at a time.
 
     Parameters
     ----------
     filename : str
         Path of the csv file to read
+    chunkSize : int
+        Largest number of lines in each chunk
+    progress : function, optional
+        Called after reading each chunk with the percentage of the file
+        already read
 
     Return
     ------
-    array : list of list of str
-        The array with all the csv file inside
+    chunks : generator
+        The first item is the list of headers. Each next item is a list
+        of at most chunkSize lines, a line being a list of str. Nothing
+        is generated when the file is empty or its headers are invalid
     """
-    csvArray = []
     with open(filename, 'rt') as fileInput:
-        isFirstLine = True
-        for row in csv.reader(fileInput):
-            if isFirstLine:
-                isFirstLine = False
-                # What we get here are the headers
-                # We can check their validity first
-                if not validateHeaders(row):
-                    return None
-            csvArray.append(row)
-    # In case of empty file
-    if isFirstLine:
-        QgsMessageLog.logMessage('Unable to load the file: empty file', 'Radiotrack', level = QGis.Critical)
-        iface.messageBar().pushCritical('Warning Radiotrack', 'Unable to load the file: empty file.')
-        return None
-    return csvArray
+        reader = csv.reader(fileInput)
+        headers = next(reader, None)
+        # In case of empty file
+        if headers is None:
+            QgsMessageLog.logMessage('Unable to load the file: empty file', 'Radiotrack', level = QGis.Critical)
+            iface.messageBar().pushCritical('Warning Radiotrack', 'Unable to load the file: empty file.')
+            return
+        if not validateHeaders(headers):
+            return
+        yield headers
+        size = max(1, os.fstat(fileInput.fileno()).st_size)
+        while True:
+            chunk = list(islice(reader, chunkSize))
+            if len(chunk) == 0:
+                return
+            if progress is not None:
+                # The position of the buffer is ahead of the reader by
+                # at most the size of the buffer
+                progress(min(100, 100 * fileInput.buffer.tell() / size))
+            yield chunk
 
 def saveArrayToCsv(array, csvFileName):
     """Save an array into a csv file.
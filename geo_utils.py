@@ -0,0 +1,244 @@
+from math import radians, degrees, sin, cos, asin, atan2
+
+import numpy as np
+
+EARTH_RADIUS = 6371
+# Smallest angle (in degrees) between two bearings that are not
+# considered parallel (they would cross hundreds of km away)
+MIN_CROSSING_ANGLE = 0.1
+
+"""
+Fonctionnalité inspiré du lien ci-dessous :
+http://www.movable-type.co.uk/scripts/latlong.html
+"""
+
+def dst(longitude, latitude, azimut, distance):
+    """
+        Calcul du nouveau point en fonction des paramètres d'un point (longitude, latitude, azimut, distance)
+    """
+    # Transformation des valeurs de degré en radian
+    rLat = radians(latitude)
+    rLong = radians(longitude)
+    rAzimut = radians(azimut)
+    quotient = distance/EARTH_RADIUS
+
+    # Calcul de la latitude et de la longitude du second point
+    rLat2 = asin(sin(rLat) * cos(quotient) + cos(rLat) * sin(quotient) * cos(rAzimut))
+    param1 = cos(quotient) - sin(rLat) * sin(rLat2)
+    param2 = sin(rAzimut) * sin(quotient) * cos(rLat)
+    rLong2 = rLong + atan2(param2,param1)
+
+    # Transformation des valeurs de radian en degré
+    return degrees(rLat2), degrees(rLong2)
+
+def dstArray(longitudes, latitudes, azimuts, distances):
+    """Vectorized version of dst
+
+    Parameters
+    ----------
+    longitudes, latitudes, azimuts : numpy.ndarray of float
+        Origin (in degrees) and direction (in degrees clockwise from the
+        north) of each point
+    distances : float or numpy.ndarray of float
+        Distance (in km) to travel from each origin
+
+    Returns
+    -------
+    latitudes, longitudes : numpy.ndarray of float
+        Destination of each point, in degrees
+    """
+    rLat = np.radians(latitudes)
+    rLong = np.radians(longitudes)
+    rAzimut = np.radians(azimuts)
+    quotient = np.asarray(distances) / EARTH_RADIUS
+
+    rLat2 = np.arcsin(np.sin(rLat) * np.cos(quotient) +
+                      np.cos(rLat) * np.sin(quotient) * np.cos(rAzimut))
+    param1 = np.cos(quotient) - np.sin(rLat) * np.sin(rLat2)
+    param2 = np.sin(rAzimut) * np.sin(quotient) * np.cos(rLat)
+    rLong2 = rLong + np.arctan2(param2, param1)
+
+    return np.degrees(rLat2), np.degrees(rLong2)
+
+def segmentDistances(x, y, x1, y1, x2, y2):
+    """Planar distances between a point and segments
+
+    Parameters
+    ----------
+    x, y : float
+        Coordinates of the point
+    x1, y1, x2, y2 : numpy.ndarray of float
+        Coordinates of the ends of each segment
+
+    Returns
+    -------
+    distances : numpy.ndarray of float
+        Distance between the point and each segment, NaN when an end of
+        the segment is NaN
+    """
+    dx = x2 - x1
+    dy = y2 - y1
+    lengths = dx * dx + dy * dy
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        # Position of the projection of the point along each segment
+        t = ((x - x1) * dx + (y - y1) * dy) / lengths
+    t = np.clip(np.where(lengths > 0, t, 0.), 0., 1.)
+    return np.hypot(x1 + t * dx - x, y1 + t * dy - y)
+
+def toVectors(latitudes, longitudes):
+    """Unit vectors (n-vectors) of positions given in degrees"""
+    rLat = np.radians(latitudes)
+    rLong = np.radians(longitudes)
+    return np.stack([np.cos(rLat) * np.cos(rLong),
+                     np.cos(rLat) * np.sin(rLong),
+                     np.sin(rLat)], axis = -1)
+
+def fromVectors(vectors):
+    """Positions in degrees (latitudes, longitudes) of unit vectors"""
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    return np.degrees(np.arctan2(z, np.hypot(x, y))), \
+        np.degrees(np.arctan2(y, x))
+
+def bearingPairsIntersection(latitudes1, longitudes1, azimuths1,
+                             latitudes2, longitudes2, azimuths2):
+    """Intersection of pairs of bearings on the sphere
+
+    Each bearing is the half great circle starting at its origin in
+    the direction of its azimuth, so the result does not depend on the
+    length of the drawn lines.
+
+    Parameters
+    ----------
+    latitudes1, longitudes1, azimuths1 : numpy.ndarray of float
+        Origin (in degrees) and direction (in degrees clockwise from the
+        north) of the first bearing of each pair
+    latitudes2, longitudes2, azimuths2 : numpy.ndarray of float
+        Same for the second bearing of each pair
+
+    Returns
+    -------
+    latitudes, longitudes : numpy.ndarray of float
+        Intersection of each pair, in degrees, NaN when the bearings are
+        parallel (see MIN_CROSSING_ANGLE) or diverge
+    """
+    def greatCircle(latitudes, longitudes, azimuths):
+        """Origin, direction and normal of the great circle of a bearing"""
+        origin = toVectors(latitudes, longitudes)
+        rLat = np.radians(latitudes)[..., None]
+        rLong = np.radians(longitudes)[..., None]
+        rAzimut = np.radians(azimuths)[..., None]
+        north = np.concatenate([-np.sin(rLat) * np.cos(rLong),
+                                -np.sin(rLat) * np.sin(rLong),
+                                np.cos(rLat)], axis = -1)
+        east = np.concatenate([-np.sin(rLong), np.cos(rLong),
+                               np.zeros_like(rLong)], axis = -1)
+        direction = np.cos(rAzimut) * north + np.sin(rAzimut) * east
+        return direction, np.cross(origin, direction)
+
+    direction1, normal1 = greatCircle(latitudes1, longitudes1, azimuths1)
+    direction2, normal2 = greatCircle(latitudes2, longitudes2, azimuths2)
+    # Both great circles cross at two antipodal points
+    crossing = np.cross(normal1, normal2)
+    norms = np.linalg.norm(crossing, axis = -1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        crossing /= norms[..., None]
+        # Keep the point ahead of both bearings
+        ahead1 = np.einsum('...i,...i', direction1, crossing)
+        ahead2 = np.einsum('...i,...i', direction2, crossing)
+        sign = np.where((ahead1 > 0) & (ahead2 > 0), 1.,
+                        np.where((ahead1 < 0) & (ahead2 < 0), -1., np.nan))
+        sign[norms <= np.sin(np.radians(MIN_CROSSING_ANGLE))] = np.nan
+    return fromVectors(crossing * sign[..., None])
+
+def bearingsIntersection(groups, latitudes, longitudes, azimuths, nbGroups):
+    """Best-fit intersection of the bearings of several groups at once
+
+    The bearings of each group are projected on the plane tangent to
+    the Earth at their mean position (the mean of their unit vectors,
+    so that groups crossing the antimeridian are handled). The
+    estimated position is the point minimizing the sum of the squared
+    distances to the bearing lines. It is rejected when it lies behind
+    one of the bearings. Groups of two bearings are intersected exactly
+    on the sphere instead (see bearingPairsIntersection), and have no
+    position when the bearings diverge.
+
+    Parameters
+    ----------
+    groups : numpy.ndarray of int
+        Index of the group of each observation, in [0, nbGroups[
+    latitudes, longitudes : numpy.ndarray of float
+        Position of each observation, in degrees
+    azimuths : numpy.ndarray of float
+        Direction of each bearing, in degrees clockwise from the north
+    nbGroups : int
+        Number of groups
+
+    Returns
+    -------
+    latitudes, longitudes : numpy.ndarray of float
+        Estimated position of each group, NaN when there are less than
+        two bearings, when they are parallel or when the position is
+        behind one of them
+    residuals : numpy.ndarray of float
+        Root mean square distance (in km) between the estimated position
+        and the bearing lines of each group, NaN when there is no position
+    """
+    def groupSum(weights):
+        return np.bincount(groups, weights = weights, minlength = nbGroups)
+
+    counts = groupSum(None)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        # Reference point of the tangent plane of each group
+        vectors = toVectors(latitudes, longitudes)
+        lat0, lon0 = fromVectors(np.stack([groupSum(vectors[:, i])
+                                           for i in range(3)], axis = -1))
+        lat0 = np.radians(lat0)
+        lon0 = np.radians(lon0)
+        cosLat0 = np.cos(lat0)
+        # Longitudes relative to the reference point, in ]-pi, pi]
+        dLon = np.radians(longitudes) - lon0[groups]
+        dLon = np.pi - np.mod(np.pi - dLon, 2 * np.pi)
+        x = EARTH_RADIUS * dLon * cosLat0[groups]
+        y = EARTH_RADIUS * (np.radians(latitudes) - lat0[groups])
+        # Unit normal of each bearing line
+        rAzimuths = np.radians(azimuths)
+        nx = np.cos(rAzimuths)
+        ny = -np.sin(rAzimuths)
+        # Normal equations: sum(n.nT) q = sum(n.nT p)
+        offsets = nx * x + ny * y
+        a11 = groupSum(nx * nx)
+        a12 = groupSum(nx * ny)
+        a22 = groupSum(ny * ny)
+        b1 = groupSum(nx * offsets)
+        b2 = groupSum(ny * offsets)
+        det = a11 * a22 - a12 * a12
+        # Parallel bearings give a singular system
+        singular = (counts < 2) | (det <= 1e-9 * counts * counts)
+        det[singular] = np.nan
+        qx = (a22 * b1 - a12 * b2) / det
+        qy = (a11 * b2 - a12 * b1) / det
+        distances = nx * qx[groups] + ny * qy[groups] - offsets
+        residuals = np.sqrt(groupSum(distances * distances) / counts)
+        # The position must be ahead of every bearing (the direction of
+        # a bearing is orthogonal to its normal)
+        ahead = -ny * (qx[groups] - x) + nx * (qy[groups] - y)
+        behind = groupSum((ahead <= 0).astype(float)) > 0
+        residuals[behind] = np.nan
+        qx[behind] = np.nan
+        qy[behind] = np.nan
+        resultLat = np.degrees(lat0 + qy / EARTH_RADIUS)
+        resultLon = np.degrees(lon0 + qx / (EARTH_RADIUS * cosLat0))
+        resultLon = 180 - np.mod(180 - resultLon, 360)
+    # Exact intersection of the pairs
+    pairs = np.flatnonzero(counts == 2)
+    if len(pairs) > 0:
+        order = np.argsort(groups, kind = 'stable')
+        first = order[np.searchsorted(groups[order], pairs)]
+        second = order[np.searchsorted(groups[order], pairs) + 1]
+        pairLat, pairLon = bearingPairsIntersection(
+            latitudes[first], longitudes[first], azimuths[first],
+            latitudes[second], longitudes[second], azimuths[second])
+        resultLat[pairs] = pairLat
+        resultLon[pairs] = pairLon
+        residuals[pairs] = np.where(np.isnan(pairLat), np.nan, 0.)
+    return resultLat, resultLon, residuals
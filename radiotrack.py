@@ -180,6 +180,7 @@ class radiotrack:
                 action)
             self.iface.removeToolBarIcon(action)
             self.iface.unregisterMainWindowAction(action)
+        self.iface.mapCanvas().unsetMapTool(self.dockwidget.mapTool)
         self.dockwidget.clear()
 
     #--------------------------------------------------------------------------
@@ -22,23 +22,28 @@
 
 import os, csv, sys
 from qgis.PyQt import uic
-from qgis.core import QgsMessageLog
+from qgis.core import QgsMessageLog, QgsApplication
 from qgis.utils import iface
 from qgis.gui import QgsMessageBar
 import qgis
 from qgis.core import Qgis as QGis
 
 from qgis.PyQt.QtGui import QKeySequence, QPalette, QColor
-from qgis.PyQt.QtCore import Qt, pyqtSignal, QVariant, QDateTime, QRect
+from qgis.PyQt.QtCore import Qt, pyqtSignal, QVariant, QDateTime, QDate, QTime, QRect, QTimer
 from qgis.PyQt.QtWidgets import QWidget, QFileDialog, QHeaderView, QStyle, QStyleOptionButton
 
 from qgis.PyQt.QtWidgets import QDockWidget, QShortcut, QItemEditorFactory, QStyledItemDelegate, QDoubleSpinBox, QDateTimeEdit
 
+import numpy as np
+
 from .manage_documentation import importDoc
 
-from .csv_utils import selectCsvFile, loadCsvToArray, saveArrayToCsv, selectSaveFile
+from .csv_utils import selectCsvFile, saveArrayToCsv, selectSaveFile
+from .csv_utils import dateTimeToEpoch, epochToDateTime, DATETIME_FORMATS
 from .radiotrack_qgs_controller import QgsController
-from .radiotrack_model import TrackingModel
+from .radiotrack_model import TrackingModel, TrackingProxyModel
+from .radiotrack_import_task import ImportTask
+from .radiotrack_map_tool import ObservationMapTool
 
 
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
@@ -109,17 +114,12 @@ class CheckBoxHeader(QHeaderView):
         pos = event.x()
         logicalIndex = self.logicalIndexAt(pos)
         if logicalIndex == 0:
-            tableView = self.parent()
-            n = tableView.model().rowCount()
-            visibleRows = [i for i in range(n) if not tableView.isRowHidden(i)]
+            model = self.dock.model
             if self.isOn:
                 state = Qt.Unchecked
             else:
                 state = Qt.Checked
-            tableView.model().itemChanged.disconnect()
-            for row in visibleRows:
-                tableView.model().setSelected(row, state)
-            tableView.model().itemChanged.connect(self.dock.refresh)
+            model.setVisibleSelected(state)
             self.dock.filter()
             self.isOn = not self.isOn
         self.update()
@@ -129,6 +129,10 @@ class CheckBoxHeader(QHeaderView):
 class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
 
     """Variables membres"""
+    # Number of rows measured for sizing the columns
+    SIZING_SAMPLE_SIZE = 100
+    # Space (in pixels) around the text of a cell
+    CELL_PADDING = 12
 
     def __init__(self, parent = None):
         """Constructor."""
@@ -140,8 +144,19 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
         """Model initialization"""
         self.model = TrackingModel(self)
         self.qgs = QgsController()
-        self.model.itemChanged.connect(self.refresh)
-        self.tableView.setModel(self.model)
+        self.model.cellChanged.connect(self.refresh)
+        """Edits are collected and applied together once per event loop
+        iteration"""
+        self.pendingEdits = {}
+        self.editTimer = QTimer(self)
+        self.editTimer.setSingleShot(True)
+        self.editTimer.setInterval(0)
+        self.editTimer.timeout.connect(self.applyEdits)
+        """Files are imported by a background task"""
+        self.importTask = None
+        self.proxyModel = TrackingProxyModel(self)
+        self.proxyModel.setSourceModel(self.model)
+        self.tableView.setModel(self.proxyModel)
         self.tableView.setSortingEnabled(True)
         checkboxHeader = CheckBoxHeader(Qt.Horizontal, self.tableView, self)
         checkboxHeader.setSectionsClickable(True)
@@ -160,6 +175,12 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
         """Empty the table and the model, and forget the CSV file"""
         self.clearButton.clicked.connect(self.clear)
         self.clearButton.setShortcut('Ctrl+Alt+C')
+        """Select a row by clicking on the map"""
+        self.mapTool = ObservationMapTool(iface.mapCanvas(), self.qgs)
+        self.mapTool.observationClicked.connect(self.showObservation)
+        self.mapTool.deactivated.connect(
+            lambda: self.mapSelectButton.setChecked(False))
+        self.mapSelectButton.clicked.connect(self.toggleMapTool)
         """Filter actions"""
         self.idFilter.addItem('All')
         self.idFilter.currentTextChanged.connect(self.filterUpdate)
@@ -178,61 +199,79 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
         self.triangulation.setPalette(palette)
         self.selected.stateChanged.connect(self.filter)
         self.resetFilterButton.clicked.connect(self.resetFilter)
-        self.tableView.horizontalHeader().sortIndicatorChanged.connect(self.filter)
         # Put all values to default ones (in particular for the date)
         self.resetFilter()
         """Date format selection"""
         self.dateComboBox.currentTextChanged.connect(self.dateTimeStart.setDisplayFormat)
         self.dateComboBox.currentTextChanged.connect(self.dateTimeEnd.setDisplayFormat)
         self.dateComboBox.currentTextChanged.connect(self.setDateTimeFormat)
-        self.dateComboBox.addItem('yyyy-MM-dd hh:mm:ss')
-        self.dateComboBox.addItem('d/M/yyyy hh:mm:ss')
-        self.dateComboBox.addItem('M/d/yyyy hh:mm:ss')
-        self.dateComboBox.addItem('hh:mm:ss d/M/yyyy')
-        self.dateComboBox.addItem('hh:mm:ss M/d/yyyy')
+        self.dateComboBox.addItems(DATETIME_FORMATS)
+        """Set triangulation tolerance"""
+        self.triangulationTolerance.valueChanged.connect(self.setTriangulationTolerance)
         """Set segment length"""
         self.segmentLength.valueChanged.connect(self.qgs.setSegmentLength)
         """Set CRS"""
         self.epsg4326.clicked.connect(self.qgs.setEPSG4326)
         self.projectCrs.clicked.connect(self.qgs.setProjectCRS)
+        """Layers backend"""
+        self.geopackage.clicked.connect(self.updateGeoPackage)
+        self.geopackagePath.editingFinished.connect(self.updateGeoPackage)
+        self.geopackageBrowse.clicked.connect(self.selectGeoPackage)
         """Intersection computation"""
         self.intersectionVisible.clicked.connect(self.qgs.toggleIntersectionsVisible)
-        self.intersectionUpdate.clicked.connect(self.intersectTriangulation)
         self.demoButton.clicked.connect(self.importDemo)
 
-    def refresh(self, item):
-        """Handle table edits
+    def refresh(self, row, col):
+        """Handle table edits (the model already reparsed the data)
+
+        The edits are collected until the next iteration of the event
+        loop, so that a burst of edits is applied at once by applyEdits.
 
         Parameters
         ----------
-        item
-            The changed item of the table
+        row, col
+            The position of the changed cell of the table
         """
-        if item.isCheckable():
-            self.filter()
+        if len(self.pendingEdits) == 0:
+            # Defer the color updates of the model too
+            self.model.beginBatch()
+            self.editTimer.start()
+        self.pendingEdits.setdefault(self.model.id(row), set()).add(col)
+
+    def applyEdits(self):
+        """Apply the collected table edits to the layers and the filters"""
+        if len(self.pendingEdits) == 0:
             return
-
-        # Disable auto refresh because we may change cells' colors
-        self.model.itemChanged.disconnect()
-        # Reparse data
-        self.model.update(item)
-        # Enable auto refresh again
-        self.model.itemChanged.connect(self.refresh)
-
-        # Add geometry if required
-        header = self.model.headerData(item.column(), Qt.Horizontal)
-        if header == 'lon' or header == 'lat' or header == 'azi':
-            rowInfo = self.model.getRow(item.row())
-            self.qgs.updateRowLinePoint(rowInfo)
-        elif header == 'id':
-            rowInfo = self.model.getRow(item.row())
-            self.qgs.setId([rowInfo])
-
-        # Re-apply filter and update filter id list
-        if header == 'id':
-            self.filterUpdate()
-        else:
-            self.filter()
+        edits = self.pendingEdits
+        self.pendingEdits = {}
+        self.model.endBatch()
+
+        # Apply all the changes of the layers at once
+        with self.qgs.batch():
+            # Add geometry if required
+            schema = self.model.schema
+            geometryCols = set([schema.lonIndex, schema.latIndex, schema.aziIndex])
+            geometryRows = []
+            idRows = []
+            dateRows = []
+            rows = self.model.rowsForIds(edits.keys())
+            for row, cols in zip(rows.tolist(), edits.values()):
+                if not geometryCols.isdisjoint(cols):
+                    geometryRows.append(self.model.getRow(row))
+                if schema.idIndex in cols:
+                    idRows.append(self.model.getRow(row))
+                if schema.dateIndex in cols:
+                    dateRows.append(self.model.getRow(row))
+            self.qgs.updateRowLinePoints(geometryRows)
+            self.qgs.setId(idRows)
+            self.qgs.setDateTime(dateRows)
+            self.updateIntersections()
+
+            # Re-apply filter and update filter id list
+            if len(idRows) > 0:
+                self.filterUpdate()
+            else:
+                self.filter()
 
         QgsMessageLog.logMessage('Project refreshed', 'Radiotrack',
                                  level = QGis.Info)
@@ -259,21 +298,37 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
                 return
         # Clear only when new file is selected
         self.clear()
-        # Load model
-        csvArray = loadCsvToArray(filename)
-        if csvArray is None:
-            return
-        self.model.itemChanged.disconnect()
-        self.model.loadArrayInModel(csvArray)
-        self.model.itemChanged.connect(self.refresh)
-        # Update canvas and create colors (must be done before
-        # initializing the filters)
         layerSuffix = ' ' + os.path.splitext(os.path.basename(filename))[0] + '__radiotrack__'
         self.qgs.setLayerSuffix(layerSuffix)
-        triangs = self.model.triangulations()
-        self.qgs.createLayers(self.model.getAll(), triangs)
+        # Load model and build layers in the background
+        task = ImportTask(filename, self.model, self.qgs)
+        if task.headers is None:
+            return
+        task.onSuccess = self.finishImport
+        self.importTask = task
+        QgsApplication.taskManager().addTask(task)
+
+    def finishImport(self, task):
+        """Display the model and the layers loaded by an import task"""
+        if task is not self.importTask:
+            return
+        self.importTask = None
+        self.model.takeData(task.model)
+        # Add layers to the canvas with the colors (must be done before
+        # initializing the filters)
+        self.qgs.takeLayers(task.qgs)
+        self.qgs.addLayers()
+        # Display the detected datetime format (the model already uses
+        # it) and apply the other settings changed during the import
+        self.dateComboBox.setCurrentText(task.datetimeFormat)
+        if self.triangulationTolerance.value() != task.tolerance:
+            self.setTriangulationTolerance(self.triangulationTolerance.value())
+        if self.qgs.segmentLength != task.qgs.segmentLength:
+            self.qgs.setSegmentLength(self.qgs.segmentLength)
+        if self.qgs.CRS != task.qgs.CRS:
+            self.qgs.updateCRS()
         # Update main and filter tab views
-        self.currentProjectText.setText(filename)
+        self.currentProjectText.setText(task.filename)
         self.updateView()
         self.resetFilter()
         # Initial population of ids with available ones in data
@@ -286,15 +341,53 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
         """
         itemDelegate = DateCoordItemDelegate(self.model)
         itemDelegate.setItemEditorFactory(DateCoordItemEditorFactory(self.model))
-        for col in range(self.model.columnCount()):
-            header = self.model.headerData(col, Qt.Horizontal)
-            if header == 'datetime' or header == 'lon' or header == 'lat':
-                self.tableView.setItemDelegateForColumn(col, itemDelegate)
-        self.tableView.resizeColumnsToContents()
-        self.tableView.resizeRowsToContents()
+        schema = self.model.schema
+        for col in (schema.dateIndex, schema.lonIndex, schema.latIndex):
+            self.tableView.setItemDelegateForColumn(col, itemDelegate)
+        self.resizeColumns()
         QgsMessageLog.logMessage('Table successfully created', 'Radiotrack',
                                  level = QGis.Info)
 
+    def resizeColumns(self):
+        """Size the columns from a sample of rows and the widest text of
+        the type of each column, and give all rows the same height
+
+        Measuring all the cells is too slow on large tables, so it is
+        only done when the table is loaded or its display format changes.
+        """
+        fontMetrics = self.tableView.fontMetrics()
+        locale = self.tableView.locale()
+        header = self.tableView.horizontalHeader()
+        nbRows = self.model.rowCount()
+        sample = np.unique(np.linspace(0, nbRows - 1,
+                                       min(nbRows, self.SIZING_SAMPLE_SIZE),
+                                       dtype = np.int64)).tolist()
+        schema = self.model.schema
+        # Widest texts of the types whose display is known
+        widest = {schema.lonIndex: [locale.toString(
+                      float(DateCoordItemDelegate.COORD_MIN), 'f',
+                      DateCoordItemDelegate.COORD_PREC)],
+                  schema.dateIndex: [QDateTime(QDate(2000, 12, 28),
+                                               QTime(23, 58, 58)).toString(
+                                                   self.model.dateTimeFormat())]}
+        widest[schema.latIndex] = widest[schema.lonIndex]
+        for col in range(1, self.model.columnCount()):
+            delegate = self.tableView.itemDelegateForColumn(col)
+            if delegate is None:
+                delegate = self.tableView.itemDelegate()
+            texts = widest.get(col, []) + \
+                [delegate.displayText(self.model.data(self.model.index(row, col)),
+                                      locale) for row in sample]
+            width = max([fontMetrics.width(text) for text in texts] + [0])
+            width = max(width + self.CELL_PADDING,
+                        header.sectionSizeFromContents(col).width())
+            self.tableView.setColumnWidth(col, width)
+        self.tableView.resizeColumnToContents(self.model.selectedCol_POS)
+        verticalHeader = self.tableView.verticalHeader()
+        verticalHeader.setSectionResizeMode(QHeaderView.Fixed)
+        verticalHeader.setDefaultSectionSize(fontMetrics.height() +
+                                             self.CELL_PADDING // 2)
+
     def saveAs(self):
         """Save selected rows
 
@@ -314,6 +407,13 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
                     iface.messageBar().pushInfo(u'Radiotrack: ', u'CSV file saved.')
 
     def clear(self):
+        # Forget the edits not applied yet
+        self.editTimer.stop()
+        self.pendingEdits = {}
+        # Stop loading the current file
+        if self.importTask is not None:
+            self.importTask.cancel()
+            self.importTask = None
         self.qgs.clearLayers()
         self.model.clear()
         self.currentProjectText.clear()
@@ -325,54 +425,37 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
         #XXX remove check eventually
         if self.model.rowCount() == 0:
             return
-        headers = [self.model.headerData(col, Qt.Horizontal)
-                   for col in range(self.model.columnCount())]
-        colId = headers.index('id')
-        colDate = headers.index('datetime')
-        rowsAdd = []
-        rowsDel = []
-        for row in range(self.model.rowCount()):
-            date = self.model.item(row, colDate).data(Qt.EditRole)
-            filterId = self.idFilter.currentText()
-            if (filterId == 'All' or
-                self.model.item(row, colId).text() == filterId) and \
-                (isinstance(date, str) or
-                 (date >= self.dateTimeStart.dateTime() and
-                  date <= self.dateTimeEnd.dateTime())) and \
-                  (not self.position.isChecked() or
-                   self.model.validPosition(row)) and \
-                   (not self.azimuth.isChecked() or
-                    self.model.validAzimuth(row)) and \
-                    (not self.datetime.isChecked() or
-                     self.model.validDatetime(row)) and \
-                     (not self.triangulation.isChecked() or
-                      self.model.triangulated(row)) and \
-                      (not self.selected.isChecked() or self.model.selected(row)):
-                if self.tableView.isRowHidden(row):
-                    rowsAdd.append(self.model.id(row))
-                    self.tableView.setRowHidden(row, False)
-            else:
-                if not self.tableView.isRowHidden(row):
-                    rowsDel.append(self.model.id(row))
-                    self.tableView.setRowHidden(row, True)
-        self.qgs.setFilter(rowsAdd, False)
-        self.qgs.setFilter(rowsDel, True)
-        self.tableView.resizeColumnsToContents()
-        self.tableView.resizeRowsToContents()
+        filterId = self.idFilter.currentText()
+        emitter = None if filterId == 'All' else filterId
+        start = dateTimeToEpoch(self.dateTimeStart.dateTime())
+        end = dateTimeToEpoch(self.dateTimeEnd.dateTime())
+        flags = self.model.filterFlags(
+            position = self.position.isChecked(),
+            azimuth = self.azimuth.isChecked(),
+            datetime = self.datetime.isChecked(),
+            triangulation = self.triangulation.isChecked(),
+            selected = self.selected.isChecked())
+        mask = self.model.filterMask(emitter = emitter, start = start,
+                                     end = end, flags = flags)
+        # Only the rows whose visibility changed are updated
+        rowsAdd, rowsDel = self.model.setVisibleRows(mask)
+        if len(rowsAdd) > 0 or len(rowsDel) > 0:
+            self.proxyModel.invalidateFilter()
+        # The layers filter the attributes of their features, and only
+        # the flags that changed are written
+        with self.qgs.batch():
+            self.qgs.setFlags(self.model.fids, self.model.rowFlags())
+            self.qgs.setFilter(emitter, start, end, flags)
+            self.qgs.updateFilter(self.model.fids[rowsAdd].tolist(),
+                                  self.model.fids[rowsDel].tolist())
 
     def updateIds(self):
         #XXX remove check eventually
         if self.model.rowCount() == 0:
             return
         # Remove orphan ids if not selected
-        # Find id column
-        headers = [self.model.headerData(col, Qt.Horizontal)
-                   for col in range(self.model.columnCount())]
-        colId = headers.index('id')
         # Get ids in data
-        ids = set()
-        for row in range(self.model.rowCount()):
-            ids.add(self.model.item(row, colId).text())
+        ids = set(self.model.rawColumn(self.model.schema.idIndex))
         # Add current filtered ids even if absent from data
         currIndex = self.idFilter.currentIndex()
         if currIndex != 0:
@@ -431,33 +514,74 @@ class RadiotrackDockWidget(QDockWidget, FORM_CLASS):
         #XXX remove check eventually
         if self.model.rowCount() == 0:
             return
-        headers = [self.model.headerData(col, Qt.Horizontal)
-                   for col in range(self.model.columnCount())]
-        colDate = headers.index('datetime')
-        smallestDate = None
-        biggestDate = None
-        for row in range(self.model.rowCount()):
-            date = self.model.item(row, colDate).data(Qt.EditRole)
-            if isinstance(date, QDateTime) and (smallestDate is None or
-                                              smallestDate > date):
-                smallestDate = date
-            if isinstance(date, QDateTime) and (biggestDate is None or
-                                              biggestDate < date):
-                biggestDate = date
-        if smallestDate is not None:
-            self.dateTimeStart.setDateTime(smallestDate)
-        if biggestDate is not None:
-            self.dateTimeEnd.setDateTime(biggestDate)
+        dates, validDates = self.model.dateTimes()
+        if not validDates.any():
+            return
+        self.dateTimeStart.setDateTime(epochToDateTime(dates[validDates].min()))
+        self.dateTimeEnd.setDateTime(epochToDateTime(dates[validDates].max()))
 
     def setDateTimeFormat(self, datetimeFormat):
-        self.model.itemChanged.disconnect()
-        self.model.setDateTimeFormat(datetimeFormat)
-        self.model.itemChanged.connect(self.refresh)
-
-    def intersectTriangulation(self):
-        """Get triangulated row ids as pairs of indices"""
-        triangs = self.model.triangulations()
-        self.qgs.updateIntersections(triangs)
+        rowIds = self.model.setDateTimeFormat(datetimeFormat)
+        rows = self.model.rowsForIds(rowIds).tolist()
+        with self.qgs.batch():
+            self.qgs.setDateTime([self.model.getRow(row) for row in rows])
+            self.updateIntersections()
+            self.filter()
+        # The datetimes are displayed with the new format
+        self.resizeColumns()
+
+    def setTriangulationTolerance(self, tolerance):
+        rowIds = self.model.setTriangulationTolerance(tolerance)
+        self.qgs.markDirty(rowIds)
+        with self.qgs.batch():
+            self.updateIntersections()
+            self.filter()
+
+    def toggleMapTool(self, checked):
+        """Use or leave the map tool selecting the clicked observation"""
+        if checked:
+            iface.mapCanvas().setMapTool(self.mapTool)
+        else:
+            iface.mapCanvas().unsetMapTool(self.mapTool)
+
+    def showObservation(self, fid):
+        """Select and show the row of an observation clicked on the map"""
+        row = self.model.rowForId(fid)
+        index = self.proxyModel.mapFromSource(self.model.index(row, 0))
+        if not index.isValid():
+            return
+        self.tabWidget.setCurrentWidget(self.init_tab)
+        self.tableView.setCurrentIndex(index)
+        self.tableView.scrollTo(index)
+
+    def updateGeoPackage(self):
+        """Store the layers of the next imported file in a GeoPackage or
+        in memory"""
+        useGeoPackage = self.geopackage.isChecked()
+        self.geopackagePath.setEnabled(useGeoPackage)
+        self.geopackageBrowse.setEnabled(useGeoPackage)
+        self.qgs.setGeoPackage(useGeoPackage, self.geopackagePath.text())
+
+    def selectGeoPackage(self):
+        """Display a selection dialog to choose the GeoPackage file"""
+        filename = QFileDialog.getSaveFileName(self, 'Select GeoPackage file',
+                                               self.geopackagePath.text(),
+                                               'GeoPackage files (*.gpkg)')[0]
+        if filename == '':
+            return
+        if os.path.splitext(filename)[-1].lower() != '.gpkg':
+            filename = filename + '.gpkg'
+        self.geopackagePath.setText(filename)
+        self.updateGeoPackage()
+
+    def updateIntersections(self):
+        """Estimate again the position of the triangulation groups changed
+        since the last update"""
+        rowIds = self.qgs.dirtyGroupRows()
+        if len(rowIds) == 0:
+            return
+        groups = self.model.triangulations(rowIds)
+        self.qgs.updateIntersections(groups)
 
     def importDemo(self, checked):
         THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
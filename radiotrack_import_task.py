@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*
+
+from qgis.core import QgsTask, QgsApplication, QgsMessageLog
+from qgis.core import Qgis as QGis
+from qgis.utils import iface
+
+from .csv_utils import readCsvChunks, detectDateTimeFormat
+from .radiotrack_model import TrackingModel
+from .radiotrack_qgs_controller import QgsController
+
+class ImportTask(QgsTask):
+    """Load a csv file and build its layers on a worker thread
+
+    The datetime format is detected on the first chunk (see
+    csv_utils.detectDateTimeFormat) and the lines are then parsed by
+    chunks into a model that is not displayed. The triangulation groups
+    and the layers are computed next, and the rows take the ids of their
+    features. Once the task is finished, the caller takes the model
+    content (see TrackingModel.takeData) and the layers (see
+    QgsController.takeLayers) on the main thread, and adds the layers to
+    the project.
+
+    The headers are read and validated when the task is created, on
+    the main thread; they are None when the file cannot be loaded. The
+    errors raised while loading are reported once the task is finished.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the csv file
+    model : TrackingModel
+        The displayed model, whose settings are used
+    qgs : QgsController
+        The displayed controller, whose settings are used
+    """
+
+    # Share of the progress given to the parsing of the file
+    PARSING_PROGRESS = 80
+
+    def __init__(self, filename, model, qgs):
+        super(ImportTask, self).__init__('Radiotrack: import ' + filename,
+                                         QgsTask.CanCancel)
+        self.filename = filename
+        # Error that made the import fail
+        self.exception = None
+        self.chunks = readCsvChunks(filename, progress = self.readProgress)
+        try:
+            self.headers = next(self.chunks, None)
+        except Exception as exception:
+            self.headers = None
+            self.exception = exception
+            self.reportError()
+        self.datetimeFormat = model.dateTimeFormat()
+        self.tolerance = model.triangulationDetector.tolerance
+        self.qgs = QgsController()
+        self.qgs.CRS = qgs.CRS
+        self.qgs.segmentLength = qgs.segmentLength
+        self.qgs.layerSuffix = qgs.layerSuffix
+        self.qgs.setGeoPackage(qgs.useGeoPackage, qgs.geopackagePath)
+        self.model = None
+        # Called with the task once it succeeded
+        self.onSuccess = None
+
+    def readProgress(self, percentage):
+        self.setProgress(percentage * self.PARSING_PROGRESS / 100)
+
+    def run(self):
+        # The exceptions raised by a task are lost, so they are kept for
+        # finished
+        try:
+            return self.load()
+        except Exception as exception:
+            self.exception = exception
+            return False
+
+    def load(self):
+        model = TrackingModel(None)
+        model.setTriangulationTolerance(self.tolerance)
+        chunk = next(self.chunks, [])
+        # The first datetimes give the format before parsing the file
+        dateIndex = self.headers.index('datetime')
+        contents = [fields[dateIndex] for fields in chunk
+                    if dateIndex < len(fields)]
+        self.datetimeFormat = detectDateTimeFormat(contents,
+                                                   self.datetimeFormat)
+        model.datetimeFormat = self.datetimeFormat
+        model.initModel(self.headers)
+        model.appendRows(chunk)
+        for chunk in self.chunks:
+            if self.isCanceled():
+                self.chunks.close()
+                return False
+            model.appendRows(chunk)
+        groups = model.triangulations()
+        self.setProgress(self.PARSING_PROGRESS + 5)
+        if self.isCanceled():
+            return False
+        array = model.getAll()
+        self.qgs.buildLayers(array, groups)
+        # The observations take the ids of their features
+        model.setIds(model.rowsForIds([row['id_observation']
+                                       for row in array]),
+                     self.qgs.bearingFids)
+        # The layers will be used by the main thread
+        mainThread = QgsApplication.instance().thread()
+        for layer in (self.qgs.layerLine, self.qgs.layerPoint,
+                      self.qgs.layerInter):
+            layer.moveToThread(mainThread)
+        self.model = model
+        self.setProgress(100)
+        return True
+
+    def finished(self, result):
+        if result:
+            if self.onSuccess is not None:
+                self.onSuccess(self)
+        elif self.exception is not None:
+            self.reportError()
+        else:
+            QgsMessageLog.logMessage('Import canceled', 'Radiotrack',
+                                     level = QGis.Warning)
+
+    def reportError(self):
+        message = 'Unable to load the file %s: %s' % (self.filename,
+                                                     self.exception)
+        QgsMessageLog.logMessage(message, 'Radiotrack', level = QGis.Critical)
+        iface.messageBar().pushCritical('Error Radiotrack', message + '.')
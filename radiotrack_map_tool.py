@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*
+
+from qgis.PyQt.QtCore import Qt, pyqtSignal
+from qgis.core import QgsRectangle
+from qgis.gui import QgsMapTool
+
+class ObservationMapTool(QgsMapTool):
+    """Map tool finding the observation clicked on the map
+
+    The observation whose point or line is the nearest to the click,
+    within the search radius of QGIS, is given by the spatial indexes
+    of the controller (see QgsController.nearestObservation).
+
+    Parameters
+    ----------
+    canvas : QgsMapCanvas
+        The map canvas of QGIS
+    qgs : QgsController
+        The controller of the layers
+    """
+
+    """Emitted with the id of the clicked observation"""
+    observationClicked = pyqtSignal(int)
+
+    def __init__(self, canvas, qgs):
+        super(ObservationMapTool, self).__init__(canvas)
+        self.qgs = qgs
+        self.setCursor(Qt.CrossCursor)
+
+    def canvasReleaseEvent(self, event):
+        layer = self.qgs.layerPoint
+        if layer is None or event.button() != Qt.LeftButton:
+            return
+        # Search area in the coordinates of the layers
+        mapPoint = self.toMapCoordinates(event.pos())
+        radius = QgsMapTool.searchRadiusMU(self.canvas())
+        rect = QgsRectangle(mapPoint.x() - radius, mapPoint.y() - radius,
+                            mapPoint.x() + radius, mapPoint.y() + radius)
+        rect = self.toLayerCoordinates(layer, rect)
+        point = self.toLayerCoordinates(layer, mapPoint)
+        fid = self.qgs.nearestObservation(point, max(rect.width(),
+                                                     rect.height()) / 2)
+        if fid is not None:
+            self.observationClicked.emit(fid)
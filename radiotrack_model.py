@@ -1,170 +1,716 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
 from qgis.core import QgsMessageLog
 from qgis.core import Qgis as QGis
-from qgis.PyQt.QtCore import Qt, QDateTime
-from qgis.PyQt.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor, QFont
+from qgis.PyQt.QtCore import Qt, QDateTime, QAbstractTableModel, QModelIndex, pyqtSignal
+from qgis.PyQt.QtCore import QSortFilterProxyModel, QLocale
+from qgis.PyQt.QtGui import QBrush, QColor, QFont
 
-from .csv_utils import types
+from .csv_utils import Schema, epochToDateTime
+from .geo_utils import bearingsIntersection
 
-class TrackingModel(QStandardItemModel):
+class TrackingModel(QAbstractTableModel):
 
     """Brushes used for the table's cells' background"""
     BRUSH_VALID_ROW = QBrush(QColor(Qt.white))
     BRUSH_TRIANGULATED_ROW = QBrush(QColor(Qt.green).lighter(100))
     BRUSH_INVALID_ROW = QBrush(QColor(Qt.red).lighter(165))
+    BRUSH_INVALID_CELL = QBrush(QColor(Qt.red).lighter(125))
 
     """Indicates specific column information/metadata"""
     selectedCol_POS = 0
-    SORT_ROLE = Qt.UserRole + 1
     ID_ROLE = Qt.UserRole + 2
 
+    """Bits of the per-row state from which the style is computed"""
+    STATE_INVALID = 0x1
+    STATE_TRIANGULATED = 0x2
+
+    """Bits of the per-row flags used by the filters (see rowFlags)"""
+    FLAG_POSITION = 0x1
+    FLAG_AZIMUTH = 0x2
+    FLAG_DATETIME = 0x4
+    FLAG_TRIANGULATED = 0x8
+    FLAG_SELECTED = 0x10
+
+    """Emitted with the row and the column of a cell edited by the user"""
+    cellChanged = pyqtSignal(int, int)
+
     def __init__(self, parent):
         super(TrackingModel, self).__init__(parent)
         self.triangulationDetector = TriangulationDetector(self)
-        self.setSortRole(self.SORT_ROLE)
-        self.setDateTimeFormat('yyyy-MM-dd hh:mm:ss')
+        self.datetimeFormat = 'yyyy-MM-dd hh:mm:ss'
+        self.initColumns([])
+        self.batchDepth = 0
+        self.pendingColorIds = set()
+
+    def initColumns(self, headers, nbRows = 0):
+        """Allocate the column arrays for the given headers
+
+        Each typed column (see csv_utils.types) is stored in a NumPy
+        array and keeps the raw text of its invalid cells on the
+        side. The other columns are stored as arrays of strings.
+        """
+        self.schema = Schema(headers, self.datetimeFormat)
+        self.fids = np.zeros(nbRows, dtype = np.int64)
+        # Row of each id, -1 for the unused ids (see indexIds)
+        self.rowOfFid = np.full(1, -1, dtype = np.int64)
+        self.selectedFlags = np.ones(nbRows, dtype = bool)
+        # Rows kept by the current filter (see setVisibleRows)
+        self.visibleFlags = np.ones(nbRows, dtype = bool)
+        self.rowState = np.zeros(nbRows, dtype = np.uint8)
+        # Bitmap of the invalid cells of each row (one bit per typed column)
+        self.invalidCells = np.zeros(nbRows, dtype = np.uint32)
+        self.cellBits = [0] * len(headers)
+        self.values = [None] * len(headers)
+        self.texts = [None] * len(headers)
+        nbTyped = 0
+        for col, parseFunction in enumerate(self.schema.types):
+            if col == self.selectedCol_POS:
+                continue
+            if parseFunction == float:
+                self.values[col] = np.full(nbRows, np.nan)
+            elif parseFunction == QDateTime:
+                self.values[col] = np.zeros(nbRows, dtype = np.int64)
+            else:
+                self.values[col] = np.full(nbRows, '', dtype = object)
+                continue
+            self.texts[col] = np.full(nbRows, None, dtype = object)
+            self.cellBits[col] = 1 << nbTyped
+            nbTyped += 1
 
     def clear(self):
-        super(TrackingModel, self).clear()
+        self.beginResetModel()
+        self.initColumns([])
         self.triangulationDetector.clear()
+        self.batchDepth = 0
+        self.pendingColorIds = set()
+        self.endResetModel()
+
+    def rowCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.fids)
+
+    def columnCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.schema.headers)
+
+    def headerData(self, section, orientation, role = Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.schema.headers[section]
+        return section + 1
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if index.column() == self.selectedCol_POS:
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable | \
+                Qt.ItemIsUserCheckable
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def cellValue(self, row, col):
+        """Typed value of a cell, or its text when the cell is invalid"""
+        if self.invalidCells[row] & self.cellBits[col]:
+            return self.texts[col][row]
+        value = self.values[col][row]
+        parseFunction = self.schema.types[col]
+        if parseFunction == QDateTime:
+            return epochToDateTime(value)
+        elif parseFunction == float:
+            return float(value)
+        return value
+
+    def rawValue(self, row, col):
+        """Stored value of a cell, or its text when the cell is invalid"""
+        if self.invalidCells[row] & self.cellBits[col]:
+            return self.texts[col][row]
+        value = self.values[col][row]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    def rawColumn(self, col):
+        """Stored values of a column, with the text of the invalid cells"""
+        invalid = (self.invalidCells & self.cellBits[col]) != 0
+        if not invalid.any():
+            return self.values[col].tolist()
+        return np.where(invalid, self.texts[col], self.values[col]).tolist()
+
+    def dateTimes(self):
+        """Datetimes of all the rows in epoch seconds (see
+        csv_utils.dateTimeToEpoch), with the mask of the valid ones"""
+        dateIndex = self.schema.dateIndex
+        valid = (self.invalidCells & self.cellBits[dateIndex]) == 0
+        return self.values[dateIndex], valid
+
+    def rowsForIds(self, rowIds):
+        """Rows of the given ids, in the same order"""
+        rowIds = np.fromiter(rowIds, dtype = np.int64)
+        return self.rowOfFid[rowIds]
+
+    def rowForId(self, rowId):
+        """Row of an id, -1 when no row has this id"""
+        if rowId < 0 or rowId >= len(self.rowOfFid):
+            return -1
+        return int(self.rowOfFid[rowId])
+
+    def text(self, row, col):
+        """Text of a cell as it is exported"""
+        if col == self.selectedCol_POS:
+            return ''
+        value = self.cellValue(row, col)
+        if isinstance(value, QDateTime):
+            return str(value.toString(self.dateTimeFormat()))
+        elif isinstance(value, float):
+            # Same text as the one of a QVariant (30 and not 30.0)
+            return QLocale.c().toString(value, 'g',
+                                        QLocale.FloatingPointShortest)
+        return str(value)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        col = index.column()
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            if col == self.selectedCol_POS:
+                return ''
+            return self.cellValue(row, col)
+        elif role == Qt.CheckStateRole:
+            if col == self.selectedCol_POS:
+                return Qt.Checked if self.selectedFlags[row] else Qt.Unchecked
+        elif role == Qt.BackgroundRole:
+            if self.invalidCells[row] & self.cellBits[col]:
+                return self.BRUSH_INVALID_CELL
+            elif self.rowState[row] & self.STATE_INVALID:
+                return self.BRUSH_INVALID_ROW
+            elif self.rowState[row] & self.STATE_TRIANGULATED:
+                return self.BRUSH_TRIANGULATED_ROW
+            return self.BRUSH_VALID_ROW
+        elif role == Qt.FontRole:
+            if self.invalidCells[row] & self.cellBits[col]:
+                font = QFont()
+                font.setBold(True)
+                return font
+        elif role == self.ID_ROLE:
+            return self.id(row)
+        return None
+
+    def setData(self, index, value, role = Qt.EditRole):
+        if not index.isValid():
+            return False
+        row = index.row()
+        col = index.column()
+        if col == self.selectedCol_POS:
+            if role != Qt.CheckStateRole:
+                return False
+            self.setSelected(row, value)
+        elif role == Qt.EditRole:
+            self.parse(row, col, value)
+            self.update(row, col)
+        else:
+            return False
+        self.cellChanged.emit(row, col)
+        return True
 
     #XXX rename id into fid (Feature id)
     def id(self, row):
-        return self.item(row, 0).data(self.ID_ROLE)
+        return int(self.fids[row])
 
     def setId(self, row, rowId):
-        self.item(row, 0).setData(rowId, self.ID_ROLE)
+        self.setIds([row], [rowId])
+
+    def setIds(self, rows, rowIds):
+        """Give new ids to rows, such as the ids of their features
+
+        Parameters
+        ----------
+        rows : numpy.ndarray of int
+            The rows to renumber
+        rowIds : numpy.ndarray of int
+            The new id of each row, not used by the other rows
+        """
+        rows = np.asarray(rows, dtype = np.int64)
+        rowIds = np.asarray(rowIds, dtype = np.int64)
+        if np.array_equal(self.fids[rows], rowIds):
+            return
+        self.indexIds(rows, rowIds)
+        # The triangulations are indexed by row id
+        self.triangulationDetector.build()
+
+    def indexIds(self, rows, rowIds):
+        """Set the ids of rows and update the index from the ids to the
+        rows, in time proportional to the number of rows"""
+        self.rowOfFid[self.fids[rows]] = -1
+        size = int(rowIds.max()) + 1 if len(rowIds) > 0 else 0
+        if size > len(self.rowOfFid):
+            # Grow geometrically for the successive appends
+            rowOfFid = np.full(max(size, 2 * len(self.rowOfFid)), -1,
+                               dtype = np.int64)
+            rowOfFid[:len(self.rowOfFid)] = self.rowOfFid
+            self.rowOfFid = rowOfFid
+        self.fids[rows] = rowIds
+        self.rowOfFid[rowIds] = rows
 
     def setDateTimeFormat(self, datetimeFormat):
+        """Change the datetime format and parse again the invalid datetimes
+
+        The texts of the invalid datetimes are parsed at once, and the
+        triangulation index is rebuilt once when some of them become
+        valid. The valid datetimes keep their value and are only
+        displayed with the new format.
+
+        Return
+        ------
+        rowIds : set
+            The ids of the rows whose triangulation may have changed
+        """
+        rowIds = set()
+        if datetimeFormat == self.datetimeFormat:
+            return rowIds
         self.datetimeFormat = datetimeFormat
+        self.schema.setDateTimeFormat(datetimeFormat)
         #XXX remove check eventually
         if self.rowCount() == 0:
-            return
-        headers = [self.headerData(col, Qt.Horizontal)
-                   for col in range(self.columnCount())]
-        dateIndex = headers.index('datetime')
-        updateColor = False
-        for row in range(self.rowCount()):
-            if self.item(row, dateIndex).parse():
-                updateColor = True
-                self.triangulationDetector.updateTriangulation(row)
-        if updateColor:
-            self.updateColor(range(self.rowCount()))
+            return rowIds
+        dateIndex = self.schema.dateIndex
+        bit = self.cellBits[dateIndex]
+        # Valid datetimes are displayed with the new format
+        self.dataChanged.emit(self.index(0, dateIndex),
+                              self.index(self.rowCount() - 1, dateIndex))
+        rows = np.flatnonzero(self.invalidCells & bit)
+        epochs, valid = self.schema.dateTimeParser.parse(
+            self.texts[dateIndex][rows].tolist())
+        rows = rows[valid]
+        if len(rows) == 0:
+            return rowIds
+        self.values[dateIndex][rows] = epochs[valid]
+        self.texts[dateIndex][rows] = None
+        self.invalidCells[rows] ^= bit
+        detector = self.triangulationDetector
+        detector.build()
+        for row in rows.tolist():
+            rowIds.add(self.id(row))
+            rowIds.update(detector.window(detector.keyForRow[self.id(row)]))
+        self.updateColor(self.rowsForIds(rowIds))
+        return rowIds
 
     def dateTimeFormat(self):
         return self.datetimeFormat
 
+    def validCell(self, row, col):
+        return not self.invalidCells[row] & self.cellBits[col]
+
     def valid(self, row):
-        for col in range(self.columnCount()):
-            if not self.item(row, col).valid():
-                return False
-        return True
+        return self.invalidCells[row] == 0
 
     def validPosition(self, row):
-        headers = [self.headerData(col, Qt.Horizontal)
-                   for col in range(self.columnCount())]
-        latIndex = headers.index('lat')
-        lonIndex = headers.index('lon')
-        return self.item(row, latIndex).valid() and \
-            self.item(row, lonIndex).valid()
+        return self.validCell(row, self.schema.latIndex) and \
+            self.validCell(row, self.schema.lonIndex)
 
     def validAzimuth(self, row):
-        headers = [self.headerData(col, Qt.Horizontal)
-                   for col in range(self.columnCount())]
-        aziIndex = headers.index('azi')
-        return self.item(row, aziIndex).valid()
+        return self.validCell(row, self.schema.aziIndex)
 
     def validDatetime(self, row):
-        headers = [self.headerData(col, Qt.Horizontal)
-                   for col in range(self.columnCount())]
-        dateIndex = headers.index('datetime')
-        return self.item(row, dateIndex).valid()
+        return self.validCell(row, self.schema.dateIndex)
 
     def triangulated(self, row):
         return self.triangulationDetector.triangulated(row)
 
-    def triangulations(self):
-        return self.triangulationDetector.triangulations()
+    def triangulations(self, rowIds = None):
+        """Triangulation groups with the best-fit position of their bearings
+
+        Parameters
+        ----------
+        rowIds : iterable, optional
+            Restrict the result to the groups containing these rows
+
+        Return
+        ------
+        result : list of dict
+            For each group, the ids of its rows ('ids'), its number of
+            rows ('size'), its estimated position ('lat' and 'lon', NaN
+            when it cannot be computed) and the root mean square
+            distance in km between this position and the bearings
+            ('residual')
+        """
+        groups = self.triangulationDetector.triangulationGroups(rowIds)
+        if len(groups) == 0:
+            return []
+        sizes = [len(group) for group in groups]
+        labels = np.repeat(np.arange(len(groups)), sizes)
+        rows = self.rowsForIds(np.concatenate(groups))
+        schema = self.schema
+        bits = self.cellBits[schema.latIndex] | \
+            self.cellBits[schema.lonIndex] | self.cellBits[schema.aziIndex]
+        valid = (self.invalidCells[rows] & bits) == 0
+        rows = rows[valid]
+        lat, lon, residual = bearingsIntersection(
+            labels[valid], self.values[schema.latIndex][rows],
+            self.values[schema.lonIndex][rows],
+            self.values[schema.aziIndex][rows], len(groups))
+        return [{'ids': group.tolist(), 'size': size, 'lat': lat[i],
+                 'lon': lon[i], 'residual': residual[i]}
+                for i, (group, size) in enumerate(zip(groups, sizes))]
+
+    def setTriangulationTolerance(self, tolerance):
+        """Set the largest gap (in seconds) between two triangulated rows
+
+        Return
+        ------
+        rowIds : set
+            The ids of the rows whose triangulation may have changed
+        """
+        rowIds = self.triangulationDetector.setTolerance(tolerance)
+        self.updateColor(self.rowsForIds(rowIds))
+        return rowIds
 
     def selected(self, row):
-        return self.item(row, self.selectedCol_POS).checkState() == Qt.Checked
+        return bool(self.selectedFlags[row])
 
     def setSelected(self, row, state):
-        self.item(row, self.selectedCol_POS).setCheckState(state)
+        self.selectedFlags[row] = state == Qt.Checked
+        index = self.index(row, self.selectedCol_POS)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
 
-    def setBrushRow(self, row, brush):
-        for col in range(self.columnCount()):
-            currentItem = self.item(row, col)
-            # Find the appropriate color
-            # This test is there to avoid turning a invalid cell into a
-            # valid cell
-            if currentItem.valid():
-                currentItem.setBackground(brush)
+    def setVisibleSelected(self, state):
+        """Select or unselect all the rows kept by the filter at once"""
+        if self.rowCount() == 0:
+            return
+        self.selectedFlags[self.visibleFlags] = state == Qt.Checked
+        self.dataChanged.emit(self.index(0, self.selectedCol_POS),
+                              self.index(self.rowCount() - 1,
+                                         self.selectedCol_POS),
+                              [Qt.CheckStateRole])
+
+    def emitRowsChanged(self, first, last):
+        self.dataChanged.emit(self.index(first, 0),
+                              self.index(last, self.columnCount() - 1))
+
+    def beginBatch(self):
+        """Defer the color updates until the matching endBatch call"""
+        self.batchDepth += 1
+
+    def endBatch(self):
+        """Apply at once the color updates deferred since beginBatch"""
+        if self.batchDepth == 0:
+            return
+        self.batchDepth -= 1
+        if self.batchDepth == 0:
+            rowIds = self.pendingColorIds
+            self.pendingColorIds = set()
+            self.updateColor(self.rowsForIds(rowIds))
 
     def updateColor(self, rows):
         """Update the color of multiple rows"""
+        rows = list(rows)
+        if len(rows) == 0:
+            return
+        if self.batchDepth > 0:
+            self.pendingColorIds.update(self.id(row) for row in rows)
+            return
+        # Both states are kept since the filter uses them separately
         for row in rows:
+            state = 0
             if not self.valid(row):
-                self.setBrushRow(row, self.BRUSH_INVALID_ROW)
-            elif self.triangulated(row):
-                self.setBrushRow(row, self.BRUSH_TRIANGULATED_ROW)
-            else:
-                self.setBrushRow(row, self.BRUSH_VALID_ROW)
+                state |= self.STATE_INVALID
+            if self.triangulated(row):
+                state |= self.STATE_TRIANGULATED
+            self.rowState[row] = state
+        self.emitRowsChanged(min(rows), max(rows))
+
+    def rowFlags(self):
+        """Flags of all the rows, computed on whole columns
+
+        Return
+        ------
+        flags : numpy.ndarray of int
+            For each row, the FLAG_* bits of its valid position, azimuth
+            and datetime, and of its triangulation and selection states
+        """
+        schema = self.schema
+        flags = np.zeros(self.rowCount(), dtype = np.int64)
+        for flag, bits in ((self.FLAG_POSITION,
+                            self.cellBits[schema.latIndex] |
+                            self.cellBits[schema.lonIndex]),
+                           (self.FLAG_AZIMUTH, self.cellBits[schema.aziIndex]),
+                           (self.FLAG_DATETIME,
+                            self.cellBits[schema.dateIndex])):
+            flags[(self.invalidCells & bits) == 0] |= flag
+        flags[(self.rowState & self.STATE_TRIANGULATED) != 0] |= \
+            self.FLAG_TRIANGULATED
+        flags[self.selectedFlags] |= self.FLAG_SELECTED
+        return flags
+
+    def filterFlags(self, position = False, azimuth = False,
+                    datetime = False, triangulation = False,
+                    selected = False):
+        """Flags that the rows kept by a filter must have (see rowFlags)
+
+        Parameters
+        ----------
+        position, azimuth, datetime : bool
+            Keep only the rows with a valid position, azimuth or datetime
+        triangulation : bool
+            Keep only the triangulated rows
+        selected : bool
+            Keep only the selected rows
+        """
+        flags = 0
+        if position:
+            flags |= self.FLAG_POSITION
+        if azimuth:
+            flags |= self.FLAG_AZIMUTH
+        if datetime:
+            flags |= self.FLAG_DATETIME
+        if triangulation:
+            flags |= self.FLAG_TRIANGULATED
+        if selected:
+            flags |= self.FLAG_SELECTED
+        return flags
+
+    def filterMask(self, emitter = None, start = None, end = None,
+                   flags = 0):
+        """Mask of the rows kept by a filter, computed on whole columns
+
+        Parameters
+        ----------
+        emitter : str, optional
+            Keep only the rows of this radioemitter
+        start, end : int, optional
+            Keep only the rows whose datetime (in epoch seconds, see
+            csv_utils.dateTimeToEpoch) is in this interval. Invalid
+            datetimes are kept
+        flags : int
+            Keep only the rows having all these flags (see filterFlags)
+
+        Return
+        ------
+        mask : numpy.ndarray of bool
+            True for each kept row
+        """
+        schema = self.schema
+        mask = np.ones(self.rowCount(), dtype = bool)
+        if emitter is not None:
+            mask &= self.values[schema.idIndex] == emitter
+        dates, validDates = self.dateTimes()
+        if start is not None:
+            mask &= ~validDates | (dates >= start)
+        if end is not None:
+            mask &= ~validDates | (dates <= end)
+        if flags != 0:
+            mask &= (self.rowFlags() & flags) == flags
+        return mask
+
+    def setVisibleRows(self, mask):
+        """Keep the rows of a filter mask (see filterMask)
+
+        Return
+        ------
+        shownRows, hiddenRows : numpy.ndarray of int
+            The rows whose visibility changed
+        """
+        changed = mask != self.visibleFlags
+        self.visibleFlags = mask
+        return np.flatnonzero(changed & mask), np.flatnonzero(changed & ~mask)
 
-    def update(self, item):
-        # Test whether the parsing was successful (when it was not
-        # already parsed)
-        success = item.parse()
+    def update(self, row, col):
         # Update triangulation data (must be done before any call to
         # triangulated) and table color
-        header = self.headerData(item.column(), Qt.Horizontal)
-        if header == 'id' or (item.valid() and header == 'datetime'):
-            self.triangulationDetector.updateTriangulation(item.row())
+        if col == self.schema.idIndex or col == self.schema.dateIndex:
+            rowIds = self.triangulationDetector.updateTriangulation(row)
             # Update the color of current row and possibly other impacted rows
-            self.updateColor(range(self.rowCount()))
-        # Update validity color of local row in case of successful parsing
-        elif success:
-            self.updateColor([item.row()])
+            rowIds.add(self.id(row))
+            self.updateColor(self.rowsForIds(rowIds))
+        # Update validity color of local row
+        else:
+            self.updateColor([row])
 
-    def loadArrayInModel(self, array):
-        """Load an array in the model/table
+    def parse(self, row, col, content):
+        """Store the content of a cell, converted to the type of its column
+
+        Return
+        ------
+        success : bool
+            False when the content cannot be converted, in which case its
+            text is kept and the cell is marked invalid
+        """
+        bit = self.cellBits[col]
+        try:
+            self.values[col][row] = self.schema.parsers[col](content)
+        except:
+            QgsMessageLog.logMessage('Error reading column %s at line %d.' %
+                                     (self.schema.headers[col], row),
+                                     'Radiotrack',
+                                     level = QGis.Warning)
+            self.texts[col][row] = str(content)
+            self.invalidCells[row] |= bit
+            return False
+        if self.invalidCells[row] & bit:
+            self.texts[col][row] = None
+            self.invalidCells[row] ^= bit
+        return True
+
+    def parseColumn(self, col, contents, first):
+        """Convert the contents of a chunk of cells of a column at once
+
+        Parameters
+        ----------
+        col : int
+            Column of the cells
+        contents : list of str
+            Text of each cell
+        first : int
+            Row of the first cell (for the error messages)
+
+        Return
+        ------
+        values : numpy.ndarray
+            Converted value of each cell
+        texts : numpy.ndarray or None
+            Text of the invalid cells (None for the valid ones), or None
+            for the columns that are not typed
+        invalid : numpy.ndarray of bool or None
+            Mask of the invalid cells, or None for the columns that are
+            not typed
+        """
+        if self.texts[col] is None:
+            return np.array(contents, dtype = object), None, None
+        texts = np.full(len(contents), None, dtype = object)
+        if self.schema.types[col] == QDateTime:
+            values, valid = self.schema.dateTimeParser.parse(contents)
+            invalid = ~valid
+            texts[invalid] = np.array(contents, dtype = object)[invalid]
+        else:
+            parser = self.schema.parsers[col]
+            values = np.zeros(len(contents), dtype = self.values[col].dtype)
+            for i, content in enumerate(contents):
+                try:
+                    values[i] = parser(content)
+                except:
+                    texts[i] = content
+            invalid = texts != None
+        for i in np.flatnonzero(invalid).tolist():
+            QgsMessageLog.logMessage('Error reading column %s at line %d.' %
+                                     (self.schema.headers[col], first + i),
+                                     'Radiotrack',
+                                     level = QGis.Warning)
+        if values.dtype == float:
+            values[invalid] = np.nan
+        return values, texts, invalid
+
+    def initModel(self, headers):
+        """Empty the model and set the headers of its columns
+
+        Parameters
+        ----------
+        headers : list of str
+            The headers of the table (without the selection column)
+        """
+        self.beginResetModel()
+        headers = list(headers)
+        headers.insert(self.selectedCol_POS, '')
+        self.initColumns(headers)
+        self.triangulationDetector.clear()
+        self.endResetModel()
+
+    def appendRows(self, array):
+        """Append a chunk of lines at the end of the model/table
+
+        Each column of the chunk is converted at once and the model
+        arrays are extended once per chunk.
 
         Parameters
         ----------
         array : list of list of str
-            The array containing the data to be displayed. The first line must be the headers of the table
+            The lines to append (without headers)
         """
-        isFirstRow = True
-        for row in array:
-            if isFirstRow:
-                row.insert(self.selectedCol_POS, '')
-                self.setHorizontalHeaderLabels(row)
-                isFirstRow = False
-            else:
-                # XXX Necessarily insert selectedCol as first value
-                items = []
-                checkbox = TrackingItem('')
-                checkbox.setCheckable(True)
-                checkbox.setCheckState(Qt.Checked)
-                items.append(checkbox)
-                for field in row:
-                    content = field
-                    item = TrackingItem(content)
-                    items.append(item)
-                self.appendRow(items)
-        for row in range(self.rowCount()):
-            for col in range(self.columnCount()):
-                self.item(row, col).parse()
-            # should start at 1 because layer ids start at 1
-            # XXX let Qgis returns these ids
-            self.setId(row, row + 1)
-            self.triangulationDetector.updateTriangulation(row)
-        self.updateColor(range(self.rowCount()))
+        nbRows = len(array)
+        if nbRows == 0:
+            return
+        first = self.rowCount()
+        nbCols = len(self.schema.headers)
+        invalidCells = np.zeros(nbRows, dtype = np.uint32)
+        columns = [None] * nbCols
+        for col in range(1, nbCols):
+            # Ignore the missing or exceeding fields
+            contents = [fields[col - 1] if col - 1 < len(fields) else ''
+                        for fields in array]
+            columns[col] = self.parseColumn(col, contents, first)
+            invalid = columns[col][2]
+            if invalid is not None:
+                invalidCells[invalid] |= self.cellBits[col]
+
+        self.beginInsertRows(QModelIndex(), first, first + nbRows - 1)
+        # Provisional ids following the last one, starting at 1 like the
+        # ids of the features, which replace them (see setIds)
+        nextId = int(self.fids.max()) + 1 if first > 0 else 1
+        self.fids = np.concatenate([self.fids,
+                                    np.zeros(nbRows, dtype = np.int64)])
+        self.indexIds(np.arange(first, first + nbRows),
+                      np.arange(nextId, nextId + nbRows))
+        self.selectedFlags = np.concatenate(
+            [self.selectedFlags, np.ones(nbRows, dtype = bool)])
+        self.visibleFlags = np.concatenate(
+            [self.visibleFlags, np.ones(nbRows, dtype = bool)])
+        self.rowState = np.concatenate(
+            [self.rowState, np.zeros(nbRows, dtype = np.uint8)])
+        self.invalidCells = np.concatenate([self.invalidCells, invalidCells])
+        for col in range(1, nbCols):
+            values, texts, invalid = columns[col]
+            self.values[col] = np.concatenate([self.values[col], values])
+            if texts is not None:
+                self.texts[col] = np.concatenate([self.texts[col], texts])
+        self.endInsertRows()
+
+        rows = range(first, first + nbRows)
+        rowIds = self.triangulationDetector.registerRows(rows)
+        rowIds.update(self.fids[first:].tolist())
+        self.updateColor(self.rowsForIds(rowIds))
+
+    def takeData(self, model):
+        """Replace the content of the model by the one of another model
+
+        It allows loading a model outside of the main thread and
+        displaying it at once.
+        """
+        self.beginResetModel()
+        self.datetimeFormat = model.datetimeFormat
+        self.schema = model.schema
+        self.fids = model.fids
+        self.rowOfFid = model.rowOfFid
+        self.selectedFlags = model.selectedFlags
+        self.visibleFlags = model.visibleFlags
+        self.rowState = model.rowState
+        self.invalidCells = model.invalidCells
+        self.cellBits = model.cellBits
+        self.values = model.values
+        self.texts = model.texts
+        self.triangulationDetector = model.triangulationDetector
+        self.triangulationDetector.model = self
+        self.endResetModel()
+
+    def sortKeys(self, col):
+        """Array used for sorting along a column"""
+        if col == self.selectedCol_POS:
+            return self.selectedFlags
+        parseFunction = self.schema.types[col]
+        invalid = (self.invalidCells & self.cellBits[col]) != 0
+        if parseFunction == float:
+            return np.where(invalid, np.inf, self.values[col])
+        elif parseFunction == QDateTime:
+            return np.where(invalid, np.iinfo(np.int64).max, self.values[col])
+        return self.values[col]
 
     def getRow(self, row):
         result = {}
-        for col in range(self.columnCount()):
-            header = self.headerData(col, Qt.Horizontal)
-            result[header] = self.item(row, col).data(Qt.EditRole)
+        for col, header in enumerate(self.schema.headers):
+            result[header] = self.data(self.index(row, col), Qt.EditRole)
         result['id_observation'] = self.id(row)
         return result
 
@@ -174,15 +720,15 @@ class TrackingModel(QStandardItemModel):
         Return
         ------
         result : list
-            The array of rows using the getRow format
+            The array of rows using the getRow format, with the flags of
+            each row ('flags', see rowFlags)
         """
-        nbRows = self.rowCount()
-        result = [None] * nbRows
-        for row in range(self.rowCount()):
-            rowInfo = self.getRow(row)
-            #XXX - 1 is a fragile operation
-            resultIndex = self.id(row) - 1
-            result[resultIndex] = rowInfo
+        flags = self.rowFlags()
+        result = []
+        for row in np.argsort(self.fids, kind = 'stable').tolist():
+            item = self.getRow(row)
+            item['flags'] = int(flags[row])
+            result.append(item)
         return result
 
     def toArraySelect(self):
@@ -193,127 +739,252 @@ class TrackingModel(QStandardItemModel):
         array : list
             The array containing all the data of the table/model
         """
-        headers = [self.headerData(col, Qt.Horizontal)
-                   for col in range(self.columnCount())]
-        array = [headers[1:]]
-        dateIndex = headers.index('datetime')
-        for row in range(self.rowCount()):
-            if self.selected(row):
-                line = []
-                for col in range(1, self.columnCount()):
-                    item = self.item(row, col)
-                    if col == dateIndex and item.valid():
-                        data = item.data(Qt.EditRole)
-                        line.append(str(data.toString(self.dateTimeFormat())))
-                    else:
-                        line.append(item.text())
-                array.append(line)
+        array = [self.schema.headers[1:]]
+        for row in np.flatnonzero(self.selectedFlags):
+            line = [self.text(row, col)
+                    for col in range(1, self.columnCount())]
+            array.append(line)
         return array
 
-class TrackingItem(QStandardItem):
-    BRUSH_VALID_CELL = QBrush(QColor(Qt.white))
-    BRUSH_INVALID_CELL = QBrush(QColor(Qt.red).lighter(125))
+class TrackingProxyModel(QSortFilterProxyModel):
+    """View of a TrackingModel showing its visible rows (see
+    TrackingModel.setVisibleRows) in the sorted order
 
-    def __init__(self, content):
-        super(TrackingItem, self).__init__()
-        self.setData(content, Qt.EditRole)
-        self.setData(content, TrackingModel.SORT_ROLE)
-
-    def setValid(self):
-        self.setBackground(self.BRUSH_VALID_CELL)
-        itemFont = self.font()
-        itemFont.setBold(False)
-        self.setFont(itemFont)
-
-    def setInvalid(self):
-        self.setBackground(self.BRUSH_INVALID_CELL)
-        itemFont = self.font()
-        itemFont.setBold(True)
-        self.setFont(itemFont)
-
-    def valid(self):
-        return self.background() != self.BRUSH_INVALID_CELL
-
-    def parse(self):
-        """Return true when an invalid cell becomes valid"""
-        if self.isCheckable():
-            return False
-        # Change the current type if not the correct one
-        header = self.model().headerData(self.column(), Qt.Horizontal)
-        parseFunction = types.get(header)
-        if parseFunction == None:
-            parseFunction = str
-        data = self.data(Qt.EditRole)
-        if isinstance(data, parseFunction):
-            return False
-        try:
-            if parseFunction != QDateTime:
-                content = parseFunction(data)
-            else:
-                content = QDateTime.fromString(data,
-                                               self.model().dateTimeFormat())
-                # Raise an exception when parsing a datetime fails
-                if content == QDateTime():
-                    raise
-            self.setData(content, Qt.EditRole)
-            self.setData(content, TrackingModel.SORT_ROLE)
-            self.setValid()
-            return True
-        except:
-            QgsMessageLog.logMessage('Error reading column %s at line %d.' %
-                                     (header, self.row()), 'Radiotrack',
-                                     level = QGis.Warning)
-            if parseFunction == float:
-                self.setData(float('inf'), TrackingModel.SORT_ROLE)
-            self.setInvalid()
-            return False
+    The source rows are never reordered. Both the filtering and the
+    sorting are applied only on request (invalidateFilter and sort).
+    """
+
+    def __init__(self, parent):
+        super(TrackingProxyModel, self).__init__(parent)
+        self.setDynamicSortFilter(False)
+        # Rank of each source row in the sorted order
+        self.ranks = None
+
+    def setSourceModel(self, model):
+        super(TrackingProxyModel, self).setSourceModel(model)
+        model.modelReset.connect(self.clearRanks)
+
+    def clearRanks(self):
+        self.ranks = None
+
+    def filterAcceptsRow(self, sourceRow, sourceParent):
+        return bool(self.sourceModel().visibleFlags[sourceRow])
+
+    def sort(self, column, order = Qt.AscendingOrder):
+        self.ranks = None
+        super(TrackingProxyModel, self).sort(column, order)
+
+    def lessThan(self, left, right):
+        # The rank of each row is computed at once, so that the
+        # comparisons do not read the data of the cells. The edited rows
+        # keep their rank until the next sort.
+        if self.ranks is None:
+            keys = self.sourceModel().sortKeys(self.sortColumn())
+            permutation = np.argsort(keys, kind = 'stable')
+            self.ranks = np.empty_like(permutation)
+            self.ranks[permutation] = np.arange(len(permutation))
+        return bool(self.ranks[left.row()] < self.ranks[right.row()])
 
 class TriangulationDetector:
+    """Find the rows of the same radioemitter measured at close datetimes
+
+    Two rows of the same emitter form a triangulation when their
+    datetimes differ by at most the tolerance (in seconds). The
+    datetimes of each emitter are kept sorted with the matching row
+    ids, so that the partners of a row are found with a binary search.
+    A reverse map gives the key under which each row is registered.
+    """
 
     def __init__(self, model):
-        self.rowsForDate = {}
         self.model = model
+        self.tolerance = 0
+        self.clear()
 
     def clear(self):
-        self.rowsForDate = {}
+        # emitter -> sorted datetimes (epoch seconds)
+        self.timesForEmitter = {}
+        # emitter -> row ids in the same order as the datetimes
+        self.idsForEmitter = {}
+        # row id -> (emitter, datetime or None when invalid)
+        self.keyForRow = {}
+
+    def build(self):
+        """Index all the rows of the model in one pass"""
+        self.clear()
+        model = self.model
+        schema = model.schema
+        emitters = model.rawColumn(schema.idIndex)
+        dates = model.values[schema.dateIndex]
+        valid = (model.invalidCells & model.cellBits[schema.dateIndex]) == 0
+        for rowId, emitter in zip(model.fids.tolist(), emitters):
+            self.keyForRow[rowId] = (emitter, None)
+        # Visiting the rows by increasing datetime keeps the lists sorted
+        for row in np.argsort(dates, kind = 'stable').tolist():
+            if valid[row]:
+                self.register(int(model.fids[row]), (emitters[row],
+                                                     int(dates[row])))
+
+    def registerRows(self, rows):
+        """Index new rows of the model
+
+        Return
+        ------
+        rowIds : set
+            The ids of the rows whose triangulation may have changed
+        """
+        model = self.model
+        schema = model.schema
+        rows = np.asarray(rows, dtype = np.int64)
+        dates = model.values[schema.dateIndex][rows]
+        valid = (model.invalidCells[rows] &
+                 model.cellBits[schema.dateIndex]) == 0
+        impacted = set()
+        # Visiting the rows by increasing datetime mostly appends to the lists
+        for i in np.argsort(dates, kind = 'stable').tolist():
+            row = int(rows[i])
+            key = (model.rawValue(row, schema.idIndex),
+                   int(dates[i]) if valid[i] else None)
+            self.register(int(model.fids[row]), key)
+            impacted.update(self.window(key))
+        return impacted
+
+    def register(self, rowId, key):
+        emitter, date = key
+        self.keyForRow[rowId] = key
+        if date is None:
+            return
+        times = self.timesForEmitter.setdefault(emitter, [])
+        ids = self.idsForEmitter.setdefault(emitter, [])
+        pos = bisect_right(times, date)
+        times.insert(pos, date)
+        ids.insert(pos, rowId)
+
+    def unregister(self, rowId):
+        key = self.keyForRow.pop(rowId, None)
+        if key is None or key[1] is None:
+            return
+        emitter, date = key
+        times = self.timesForEmitter[emitter]
+        ids = self.idsForEmitter[emitter]
+        pos = bisect_left(times, date)
+        while ids[pos] != rowId:
+            pos += 1
+        del times[pos]
+        del ids[pos]
+        # Remove empty lists
+        if len(times) == 0:
+            del self.timesForEmitter[emitter]
+            del self.idsForEmitter[emitter]
+
+    def window(self, key):
+        """Ids of the rows within the tolerance of a key (itself included)"""
+        emitter, date = key
+        if date is None or emitter not in self.timesForEmitter:
+            return []
+        times = self.timesForEmitter[emitter]
+        first = bisect_left(times, date - self.tolerance)
+        last = bisect_right(times, date + self.tolerance)
+        return self.idsForEmitter[emitter][first:last]
 
     def updateTriangulation(self, row):
-        headers = [self.model.headerData(col, Qt.Horizontal)
-                   for col in range(self.model.columnCount())]
-        idSpIndex = headers.index('id')
-        dateIndex = headers.index('datetime')
-        rowId = self.model.id(row)
-        rowIdSp = self.model.item(row, idSpIndex).text()
-        rowDate = self.model.item(row, dateIndex).text()
-
-        # Remove previous values
-        for emitterId in self.rowsForDate:
-            for _, rowIds in self.rowsForDate[emitterId].items():
-                rowIds.discard(rowId)
-
-        # Create the set if it doesn't exist
-        if rowIdSp not in self.rowsForDate:
-            self.rowsForDate[rowIdSp] = {}
-        if rowDate not in self.rowsForDate[rowIdSp]:
-            self.rowsForDate[rowIdSp][rowDate] = set()
-        # Register the row into the dates map
-        self.rowsForDate[rowIdSp][rowDate].add(rowId)
+        """Move a row to its current emitter and datetime
+
+        Return
+        ------
+        rowIds : set
+            The ids of the rows whose triangulation may have changed
+        """
+        model = self.model
+        schema = model.schema
+        rowId = model.id(row)
+        date = None
+        if model.validCell(row, schema.dateIndex):
+            date = model.rawValue(row, schema.dateIndex)
+        key = (model.rawValue(row, schema.idIndex), date)
+        previousKey = self.keyForRow.get(rowId)
+        if previousKey == key:
+            return set()
+        impacted = set()
+        if previousKey is not None:
+            impacted.update(self.window(previousKey))
+            self.unregister(rowId)
+        self.register(rowId, key)
+        impacted.update(self.window(key))
+        return impacted
+
+    def setTolerance(self, tolerance):
+        """Change the tolerance
+
+        Return
+        ------
+        rowIds : set
+            The ids of the rows whose triangulation or triangulation group
+            may have changed, that is the rows having a neighbour between
+            both tolerances
+        """
+        low, high = sorted((self.tolerance, tolerance))
+        self.tolerance = tolerance
+        changed = set()
+        for emitter, times in self.timesForEmitter.items():
+            gaps = np.diff(np.array(times, dtype = np.int64))
+            between = (gaps > low) & (gaps <= high)
+            neighbours = np.zeros(len(times), dtype = bool)
+            neighbours[:-1] = between
+            neighbours[1:] |= between
+            ids = self.idsForEmitter[emitter]
+            changed.update(ids[pos] for pos in np.flatnonzero(neighbours).tolist())
+        return changed
 
     def triangulated(self, row):
-        headers = [self.model.headerData(col, Qt.Horizontal)
-                   for col in range(self.model.columnCount())]
-        idSpIndex = headers.index('id')
-        dateIndex = headers.index('datetime')
-        rowIdSp = self.model.item(row, idSpIndex).text()
-        rowDate = self.model.item(row, dateIndex).text()
-        return len(self.rowsForDate[rowIdSp][rowDate]) >= 2
-
-    def triangulations(self):
-        triangs = {}
-        for rowIdSp, idDict in self.rowsForDate.items():
-            for _, idDateSet in idDict.items():
-                for id1 in idDateSet:
-                    for id2 in idDateSet:
-                        if id1 < id2:
-                            triangs[id1] = id2
-        return triangs
+        return len(self.window(self.keyForRow[self.model.id(row)])) >= 2
+
+    def groupBounds(self, rowId):
+        """Emitter and slice of the triangulation group of a row"""
+        emitter, date = self.keyForRow[rowId]
+        if date is None:
+            return None
+        times = self.timesForEmitter[emitter]
+        ids = self.idsForEmitter[emitter]
+        pos = bisect_left(times, date)
+        while ids[pos] != rowId:
+            pos += 1
+        first = pos
+        while first > 0 and times[first] - times[first - 1] <= self.tolerance:
+            first -= 1
+        last = pos + 1
+        while last < len(times) and \
+              times[last] - times[last - 1] <= self.tolerance:
+            last += 1
+        return emitter, first, last
+
+    def triangulationGroups(self, rowIds = None):
+        """Split the rows of each emitter into triangulation groups
+
+        A group is a sequence of rows in which each datetime is within
+        the tolerance of the previous one.
+
+        Parameters
+        ----------
+        rowIds : iterable, optional
+            Restrict the result to the groups containing these rows
+
+        Return
+        ------
+        groups : list of numpy.ndarray
+            The ids of the rows of each group having at least two rows
+        """
+        if rowIds is not None:
+            bounds = set(self.groupBounds(rowId) for rowId in rowIds
+                         if rowId in self.keyForRow)
+            bounds.discard(None)
+            return [np.array(self.idsForEmitter[emitter][first:last],
+                             dtype = np.int64)
+                    for emitter, first, last in bounds if last - first >= 2]
+        groups = []
+        for emitter, times in self.timesForEmitter.items():
+            ids = np.array(self.idsForEmitter[emitter], dtype = np.int64)
+            gaps = np.diff(np.array(times, dtype = np.int64))
+            starts = np.flatnonzero(gaps > self.tolerance) + 1
+            groups.extend(group for group in np.split(ids, starts)
+                          if len(group) >= 2)
+        return groups
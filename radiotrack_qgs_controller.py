@@ -2,25 +2,39 @@
 
 from random import randrange
 from math import *
+from contextlib import contextmanager
 
+from qgis.PyQt.QtCore import QDateTime
 from qgis.utils import iface
 from qgis.core import QgsProject, QgsMessageLog, Qgis
-from qgis.core import QgsVectorLayer, QgsFeature, QgsField, edit
-from qgis.core import QgsGeometry, QgsPoint, QgsPointXY, QgsWkbTypes
+from qgis.core import QgsVectorLayer, QgsFeature, QgsFeatureRequest
+from qgis.core import QgsVectorDataProvider, QgsExpression
+from qgis.core import QgsVectorFileWriter
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsGeometry, QgsPoint, QgsPointXY
+from qgis.core import QgsRectangle, QgsSpatialIndex
 from qgis.core import QgsCoordinateTransform, QgsCoordinateReferenceSystem
 from qgis.core import QgsCategorizedSymbolRenderer, QgsRendererCategory, QgsMarkerSymbol
-from qgis.PyQt.QtCore import QVariant
 from qgis.core import Qgis as QGis
 
-from .csv_utils import labels
+import numpy as np
 
-RADIAN_DE_LA_TERRE = 6371
+from .csv_utils import labels, dateTimeToEpoch
+from .geo_utils import dst, dstArray, segmentDistances
 
 class QgsController:
 
     LINE_LAYER_BASE_NAME = 'lines'
     POINT_LAYER_BASE_NAME = 'points'
     INTER_LAYER_BASE_NAME = 'intersections'
+    # Fields of all the layers, in the memory provider syntax. The flags
+    # are the ones of the rows (see TrackingModel.rowFlags). The
+    # datetime is in epoch seconds (see csv_utils.dateTimeToEpoch), NULL
+    # when invalid
+    LAYER_FIELDS = ('field=id:string&field=flags:integer'
+                    '&field=datetime:long')
+    # Fields used by the subset expressions (see filterSubsetString)
+    FILTER_FIELDS = ['id', 'flags', 'datetime']
 
     def __init__(self):
         # Store references to the layers
@@ -32,8 +46,28 @@ class QgsController:
         self.layerSuffix = ''
         # Autozoom and properties
         self.currExtent = None
+        # Bounding box of the shown points and lines, None when it must be
+        # computed again (see visibleExtent)
+        self.visibleBounds = None
+        # Coordinate transforms of each pair of CRSs (see transform)
+        self.transforms = {}
         self.segmentLength = 1
         self.layerInterVisible = False
+        # Backend of the next built layers (see setGeoPackage)
+        self.useGeoPackage = False
+        self.geopackagePath = ''
+        # The subset expressions of GeoPackage layers are in SQL
+        self.layersInGeoPackage = False
+        # Triangulation groups drawn on the intersections layer
+        self.clearGroups()
+        # Features hidden by the filter
+        self.hiddenFids = set()
+        self.clearFilterCriteria()
+        # Spatial indexes of the points and of the lines (see buildIndex)
+        self.clearIndexes()
+        # Changes collected during a batch (see batch)
+        self.batchDepth = 0
+        self.clearPendingChanges()
 
     def setLayerSuffix(self, layerSuffix):
         """Indicate the suffix of all layers.
@@ -45,13 +79,35 @@ class QgsController:
         """
         self.layerSuffix = layerSuffix
 
-    def createLayers(self, array, triangs):
-        """Create a layer based on the given model rows.
+    def setGeoPackage(self, useGeoPackage, path = ''):
+        """Indicate where the next built layers are stored
 
         Parameters
         ----------
-        array : list of TrackingModel items
-        triangs : dict containing all triangulation correspondences
+        useGeoPackage : bool
+            Store the layers in a GeoPackage instead of memory
+        path : str
+            The GeoPackage file, overwritten when building the layers.
+            A temporary file is used when empty.
+        """
+        self.useGeoPackage = useGeoPackage
+        self.geopackagePath = path
+
+    def buildLayers(self, array, groups):
+        """Build the layers of the given model rows without adding them to
+        the project, so that it can be done outside of the main thread.
+
+        The observations are identified by the ids that the provider
+        gives to their features. These ids are in bearingFids, in the
+        order of the rows, and must be given to the model (see
+        TrackingModel.setIds).
+
+        Parameters
+        ----------
+        array : list of TrackingModel items, with their flags (see
+            TrackingModel.getAll)
+        groups : list of triangulation groups (see
+            TrackingModel.triangulations)
         """
 
         # Create specific renderer for coloring depending on id
@@ -61,18 +117,119 @@ class QgsController:
         self.idRendInter.setClassAttribute('id')
 
         # Draw the available points on their layers
+        self.initLayers()
         self.drawLines(array)
+        # The rows take the ids of their lines
+        array, groups = renumberRows(array, groups, self.bearingFids)
         self.drawPoints(array)
-        self.drawIntersections(triangs)
-        iface.layerTreeView().setLayerVisible(self.layerInter, self.layerInterVisible)
+        self.drawIntersections(groups, array)
+        self.flagsOfFid = np.zeros(self.bearingFids.max(initial = 0) + 1,
+                                   dtype = np.int64)
+        self.flagsOfFid[self.bearingFids] = [row['flags'] for row in array]
+        for layer in (self.layerLine, self.layerPoint, self.layerInter):
+            indexFields(layer, self.FILTER_FIELDS)
+
+        # Custom renderers for colors
+        self.layerPoint.setRenderer(self.idRendPoint)
+        self.layerInter.setRenderer(self.idRendInter)
 
-        # Setting the id
-        self.setId(array)
+        # Colors of the ids
+        ids = [row['id'] for row in array]
+        self.updateRenderer(self.idRendPoint, ids, 3)
+        self.updateRenderer(self.idRendInter, ids, 2)
+        # All the groups were just computed
+        self.dirtyRows = set()
+        # All the features are shown
+        self.hiddenFids = set()
+        self.clearFilterCriteria()
+        self.visibleBounds = None
+
+    def takeLayers(self, controller):
+        """Take the layers built by another controller (see buildLayers)"""
+        self.layerLine = controller.layerLine
+        self.layerPoint = controller.layerPoint
+        self.layerInter = controller.layerInter
+        self.idRendPoint = controller.idRendPoint
+        self.idRendInter = controller.idRendInter
+        self.bearingFids = controller.bearingFids
+        self.bearingIndex = controller.bearingIndex
+        self.bearings = controller.bearings
+        self.rowsOfGroup = controller.rowsOfGroup
+        self.groupOfRow = controller.groupOfRow
+        self.dirtyRows = controller.dirtyRows
+        self.hiddenFids = controller.hiddenFids
+        self.filterCriteria = controller.filterCriteria
+        self.flagsOfFid = controller.flagsOfFid
+        self.visibleBounds = controller.visibleBounds
+        self.pointIndex = controller.pointIndex
+        self.pointBounds = controller.pointBounds
+        self.lineIndex = controller.lineIndex
+        self.lineBounds = controller.lineBounds
+        self.layersInGeoPackage = controller.layersInGeoPackage
+
+    def addLayers(self):
+        """Add the built layers to the project (from the main thread)"""
+        # Add the layers to the Layers panel
+        QgsProject.instance().addMapLayers([self.layerLine, self.layerPoint,
+                                            self.layerInter])
+        iface.layerTreeView().setLayerVisible(self.layerInter, self.layerInterVisible)
 
         # If zoom set has not changed (autozoom), adjust the zoom
         if self.autoZoom():
             self.updateZoom()
 
+    @contextmanager
+    def batch(self):
+        """Context in which the changes of the layers are collected, and
+        applied when leaving it: one provider call per layer and per kind
+        of change, one repaint per layer and at most one zoom update.
+        Batches can be nested."""
+        self.batchDepth += 1
+        try:
+            yield
+        finally:
+            self.batchDepth -= 1
+            if self.batchDepth == 0:
+                self.flush()
+
+    def clearPendingChanges(self):
+        # layer id -> (layer, {feature id: geometry})
+        self.pendingGeometries = {}
+        # layer id -> (layer, {feature id: {field index: value}})
+        self.pendingAttributes = {}
+        self.pendingFilter = False
+        self.pendingZoom = False
+
+    def flush(self):
+        """Apply the changes collected since the last flush"""
+        geometries = self.pendingGeometries
+        attributes = self.pendingAttributes
+        pendingFilter = self.pendingFilter
+        pendingZoom = self.pendingZoom
+        self.clearPendingChanges()
+        changed = {}
+        # The providers are written directly, without edit sessions
+        for layerId, (layer, layerGeometries) in geometries.items():
+            layer.dataProvider().changeGeometryValues(layerGeometries)
+            changed[layerId] = layer
+        for layerId, (layer, layerAttributes) in attributes.items():
+            layer.dataProvider().changeAttributeValues(layerAttributes)
+            changed[layerId] = layer
+        if pendingFilter:
+            subsetString = self.filterSubsetString()
+            # The index of the lines is built from the shown features
+            self.lineIndex = None
+            for layer in (self.layerLine, self.layerPoint, self.layerInter):
+                if layer is not None:
+                    layer.setSubsetString(subsetString)
+                    changed[layer.id()] = layer
+        for layer in changed.values():
+            layer.triggerRepaint()
+            layer.updateExtents()
+        # If zoom set has not changed (autozoom), adjust the zoom
+        if pendingZoom and self.layerPoint is not None and self.autoZoom():
+            self.updateZoom()
+
     def clearLayers(self):
         self.clearLayer(self.layerInter)
         self.layerInter = None
@@ -82,6 +239,34 @@ class QgsController:
         self.layerLine = None
         iface.mapCanvas().refresh()
         self.currExtent = None
+        self.visibleBounds = None
+        self.transforms = {}
+        self.clearPendingChanges()
+        self.clearGroups()
+        self.clearIndexes()
+        self.hiddenFids = set()
+        self.clearFilterCriteria()
+
+    def clearGroups(self):
+        # representative (first) row id -> row ids of the group
+        self.rowsOfGroup = {}
+        # row id -> representative row id of its group
+        self.groupOfRow = {}
+        # row ids whose group must be recomputed
+        self.dirtyRows = set()
+
+    def clearFilterCriteria(self):
+        # Radioemitter, interval (in epoch seconds) and flags of the
+        # filter, None or 0 when not filtered (see setFilter)
+        self.filterCriteria = (None, None, None, 0)
+
+    def clearIndexes(self):
+        # Flags written on the features, by feature id (see setFlags)
+        self.flagsOfFid = np.zeros(0, dtype = np.int64)
+        self.pointIndex = None
+        self.pointBounds = None
+        self.lineIndex = None
+        self.lineBounds = None
 
     def clearLayer(self, layer):
         """Suppression d'un layer (clear)"""
@@ -92,125 +277,405 @@ class QgsController:
                 QgsMessageLog.logMessage('Layer already removed',
                                          'Radiotrack', level = Qgis.Info)
 
+    def initLayers(self):
+        """Create the empty layers, in memory or in a GeoPackage (see
+        setGeoPackage)"""
+        # Specify the geometry type and the fields
+        self.layerLine = QgsVectorLayer('LineString?crs=epsg:4326&' +
+                                        self.LAYER_FIELDS,
+                                        self.LINE_LAYER_BASE_NAME +
+                                        self.layerSuffix, 'memory')
+        self.layerPoint = QgsVectorLayer('Point?crs=epsg:4326&' +
+                                         self.LAYER_FIELDS,
+                                         self.POINT_LAYER_BASE_NAME +
+                                         self.layerSuffix, 'memory')
+        self.layerInter = QgsVectorLayer('Point?crs=epsg:4326&' +
+                                         self.LAYER_FIELDS +
+                                         '&field=size:integer'
+                                         '&field=residual:double',
+                                         self.INTER_LAYER_BASE_NAME +
+                                         self.layerSuffix, 'memory')
+        self.layersInGeoPackage = False
+        if self.useGeoPackage:
+            self.storeLayers()
+
     def drawLines(self, rows):
         """Draw the lines on a layer
         """
-
-        # Specify the geometry type
-        layerName = self.LINE_LAYER_BASE_NAME + self.layerSuffix
-        self.layerLine = QgsVectorLayer('LineString?crs=epsg:4326',
-                                        layerName, 'memory')
         # Create and add lines
-        geometries = [self.makeLineGeometry(row) for row in rows]
+        self.setBearings(rows)
+        geometries = self.makeLineGeometries()
+        attributes = self.rowAttributes(self.layerLine, rows)
 
-        self.initLayerFeatures(self.layerLine, geometries)
-
-        #XXX return fids here
-        fids = [feature.id() for feature in self.layerLine.getFeatures()]
+        fids = self.initLayerFeatures(self.layerLine, geometries, attributes)
+        self.setBearingFids(fids)
+        self.lineIndex = buildIndex(self.layerLine)
+        self.lineBounds = lineBounds(self.bearings, self.segmentLength)
 
     def drawPoints(self, rows):
         """Draw the points on a layer
         """
-
-        # Specify the geometry type
-        layerName = self.POINT_LAYER_BASE_NAME + self.layerSuffix
-        self.layerPoint = QgsVectorLayer('Point?crs=epsg:4326',
-                                         layerName, 'memory')
         # Create and add points
         geometries = [self.makePointGeometry(row) for row in rows]
-
-        self.initLayerFeatures(self.layerPoint, geometries)
-
-        # Custom renderer for colors
-        self.layerPoint.setRenderer(self.idRendPoint)
-
-        #XXX return ids here (check this it the same as for line)
-        fids = [feature.id() for feature in self.layerPoint.getFeatures()]
-
-    def drawIntersections(self, triangs):
-        # Specify the geometry type
-        layerName = self.INTER_LAYER_BASE_NAME + self.layerSuffix
-        self.layerInter = QgsVectorLayer('Point?crs=epsg:4326',
-                                         layerName, 'memory')
-
-        # Create and add points
-        geometries = self.computeIntersections(triangs).values()
-        self.initLayerFeatures(self.layerInter, geometries)
-
-        # Custom renderer for colors
-        self.layerInter.setRenderer(self.idRendInter)
-
-    def computeIntersections(self, triangs):
-        """Compute all intersections between corresponding filtered lines."""
+        attributes = self.rowAttributes(self.layerPoint, rows)
+
+        fids = self.initLayerFeatures(self.layerPoint, geometries, attributes)
+        self.checkFeatureIds(self.layerPoint, fids)
+        self.pointIndex = buildIndex(self.layerPoint)
+        self.pointBounds = pointBounds(self.bearings)
+
+    def drawIntersections(self, groups, rows):
+        # Create and add points (one per row, only the first row of each
+        # triangulation group has a position)
+        geometries = {row['id_observation']: QgsGeometry() for row in rows}
+        geometries.update(self.computeIntersections(groups))
+        groupAttributes = self.intersectionAttributes(groups)
+        attributes = self.rowAttributes(self.layerInter, rows)
+        for row, values in zip(rows, attributes):
+            for fieldIdx, value in groupAttributes.get(row['id_observation'],
+                                                       {}).items():
+                values[fieldIdx] = value
+        fids = self.initLayerFeatures(self.layerInter, geometries.values(),
+                                      attributes)
+        self.checkFeatureIds(self.layerInter, fids)
+
+    def computeIntersections(self, groups):
+        """Give the estimated position of each triangulation group to the
+        feature of its first row, and remember the rows of each group."""
         geometries = {}
-        fids = [feature.id() for feature in self.layerPoint.getFeatures()]
-        for fid in fids:
+        for group in groups:
+            groupId = min(group['ids'])
+            self.rowsOfGroup[groupId] = group['ids']
+            for rowId in group['ids']:
+                self.groupOfRow[rowId] = groupId
             geom = QgsGeometry()
-            if fid in triangs:
-                geom1 = self.layerLine.getGeometry(fid)
-                geom2 = self.layerLine.getGeometry(triangs[fid])
-                newGeom = geom1.intersection(geom2)
-                if newGeom.type() == QgsWkbTypes.PointGeometry:
-                    geom = newGeom
-            geometries[fid] = geom
+            if isfinite(group['lat']) and isfinite(group['lon']):
+                point = QgsPointXY(group['lon'], group['lat'])
+                geom = QgsGeometry.fromPointXY(point)
+            geometries[groupId] = geom
         return geometries
 
-    def initLayerFeatures(self, layer, geometries):
-        features = [QgsFeature() for i in geometries]
-        for geom, feat in zip(geometries, features):
+    def intersectionAttributes(self, groups):
+        """Size and residual of each triangulation group, for the feature
+        holding its position."""
+        prov = self.layerInter.dataProvider()
+        sizeIdx = prov.fieldNameIndex('size')
+        residualIdx = prov.fieldNameIndex('residual')
+        attrs = {}
+        for group in groups:
+            residual = group['residual']
+            attrs[min(group['ids'])] = {
+                sizeIdx: group['size'],
+                residualIdx: float(residual) if isfinite(residual) else None
+            }
+        return attrs
+
+    def rowAttributes(self, layer, rows):
+        """Attributes of the features of rows (see LAYER_FIELDS), in the
+        order of the fields of a layer"""
+        fields = layer.fields()
+        idIdx = fields.indexOf('id')
+        flagsIdx = fields.indexOf('flags')
+        dateIdx = fields.indexOf('datetime')
+        attributes = []
+        for row in rows:
+            values = [None] * fields.count()
+            values[idIdx] = row['id']
+            values[flagsIdx] = row['flags']
+            values[dateIdx] = rowEpoch(row)
+            attributes.append(values)
+        return attributes
+
+    def initLayerFeatures(self, layer, geometries, attributes):
+        """Add all the features of a layer, with their geometry and their
+        attributes, in a single provider call (thus a single transaction
+        in a GeoPackage)
+
+        Return
+        ------
+        fids : list of int
+            The ids given by the provider to the features, in order
+        """
+        fields = layer.fields()
+        features = []
+        for geom, values in zip(geometries, attributes):
+            feat = QgsFeature(fields)
             feat.setGeometry(geom)
+            feat.setAttributes(values)
+            features.append(feat)
         prov = layer.dataProvider()
-        prov.addFeatures(features)
+        result, features = prov.addFeatures(features)
         # Specify the geometry type
         layer.setCrs(self.CRS)
         # Avoid warning when closing project
         layer.setCustomProperty('skipMemoryLayersCheck', 1)
-        with edit(layer):
-            layer.addAttribute(QgsField('id', QVariant.String))
-            layer.addAttribute(QgsField('filter', QVariant.Int))
-            layer.addAttribute(QgsField('triangulation', QVariant.Int))
-        self.initFilter(layer)
-        # Setting the filter must be called after initializing the
-        # filter attributes
-        layer.setSubsetString('NOT filter')
-
-        # Add the layer to the Layers panel
-        QgsProject.instance().addMapLayers([layer])
-
-    def updateRowLinePoint(self, row):
-        """Update the value of a single observation"""
-        idRow = row['id_observation']
-
-        newGeometry = self.makeLineGeometry(row)
-        self.updateRowGeometry(self.layerLine, {idRow: newGeometry})
-
-        newGeometry = self.makePointGeometry(row)
-        self.updateRowGeometry(self.layerPoint, {idRow: newGeometry})
-
-        """The current row geometries are updated when the row is edited.
-        Thus, it is not an hidden row. Thus, if it has to be kept by the
-        filter and the filtering will not be updated. In this case, we need
-        to initialize the value to False."""
-        self.setFilter([idRow], False)
-
-    def updateIntersections(self, triangs):
-        """This method is required to update manually the intersections
-        anytime there is an update to the data (keeping track of each
-        change would be too cumbersome).
+        return [feat.id() for feat in features]
+
+    def checkFeatureIds(self, layer, fids):
+        """Warn when the features of a layer do not have the ids of the
+        observations, in the same order (see bearingFids)"""
+        if not np.array_equal(fids, self.bearingFids):
+            QgsMessageLog.logMessage('The features of the layer %s do not '
+                                     'match the observations.' % layer.name(),
+                                     'Radiotrack', level = Qgis.Critical)
+            return False
+        return True
+
+    def storeLayers(self):
+        """Replace the empty memory layers by layers of a GeoPackage
+
+        The layers are created with their R-tree spatial index, and the
+        features are then written directly in the GeoPackage (see
+        initLayerFeatures), so they are never held in memory. The later
+        changes of the features are also applied by one provider call
+        (thus one transaction) per layer (see flush).
+        """
+        path = self.geopackagePath
+        if path == '':
+            path = QgsProcessingUtils.generateTempFilename('radiotrack.gpkg')
+        action = QgsVectorFileWriter.CreateOrOverwriteFile
+        layers = []
+        for layer, baseName in ((self.layerLine, self.LINE_LAYER_BASE_NAME),
+                                (self.layerPoint, self.POINT_LAYER_BASE_NAME),
+                                (self.layerInter, self.INTER_LAYER_BASE_NAME)):
+            # This constructor is the one available since QGIS 3.0
+            writer = QgsVectorFileWriter(path, 'UTF-8', layer.fields(),
+                                         layer.wkbType(), layer.crs(), 'GPKG',
+                                         [], ['FID=fid', 'SPATIAL_INDEX=YES'],
+                                         None, QgsVectorFileWriter.NoSymbology,
+                                         None, baseName, action)
+            error = writer.hasError()
+            message = writer.errorMessage()
+            # Close the file
+            del writer
+            if error != QgsVectorFileWriter.NoError:
+                QgsMessageLog.logMessage('Unable to write the GeoPackage '
+                                         '%s: %s. The layers are kept in '
+                                         'memory.' % (path, message),
+                                         'Radiotrack', level = Qgis.Warning)
+                return
+            # The next layers are added to the same file
+            action = QgsVectorFileWriter.CreateOrOverwriteLayer
+            stored = QgsVectorLayer(path + '|layername=' + baseName,
+                                    layer.name(), 'ogr')
+            if not stored.isValid():
+                QgsMessageLog.logMessage('Unable to open the layer %s of the '
+                                         'GeoPackage %s. The layers are kept '
+                                         'in memory.' % (baseName, path),
+                                         'Radiotrack', level = Qgis.Warning)
+                return
+            layers.append(stored)
+        self.layerLine, self.layerPoint, self.layerInter = layers
+        self.layersInGeoPackage = True
+
+    def updateRowLinePoints(self, rows):
+        """Update the values of several observations at once"""
+        if len(rows) == 0:
+            return
+        idRows = [row['id_observation'] for row in rows]
+
+        with self.batch():
+            for row in rows:
+                self.updateBearing(row)
+            self.markDirty(idRows)
+            # The previous boxes of the shown rows may be the limits of the
+            # visible extent
+            indexes = [self.bearingIndex[fid] for fid in idRows]
+            self.shrinkVisibleBounds([i for i, fid in zip(indexes, idRows)
+                                      if fid not in self.hiddenFids])
+            newGeometries = {row['id_observation']: self.makeLineGeometry(row)
+                             for row in rows}
+            self.updateRowGeometry(self.layerLine, newGeometries)
+            self.updateIndex(self.lineIndex, self.lineBounds, newGeometries)
+
+            newGeometries = {row['id_observation']: self.makePointGeometry(row)
+                             for row in rows}
+            self.updateRowGeometry(self.layerPoint, newGeometries)
+            self.updateIndex(self.pointIndex, self.pointBounds, newGeometries)
+            # The filter of the edited rows is updated afterwards, with
+            # all the other edits (see updateFilter)
+            self.growVisibleBounds([i for i, fid in zip(indexes, idRows)
+                                    if fid not in self.hiddenFids])
+
+    def updateIndex(self, index, bounds, geometries):
+        """Move the changed features in a spatial index
 
+        Parameters
+        ----------
+        index : QgsSpatialIndex
+            The index of the points or of the lines (see buildIndex), None
+            when it will be built again (see nearestObservation)
+        bounds : numpy.ndarray of float
+            The bounding boxes of the indexed features, updated
+        geometries : dict
+            The new geometry of each changed feature id
         """
-        # Create and add points
-        geometries = self.computeIntersections(triangs)
-        self.updateRowGeometry(self.layerInter, geometries)
+        for fid, geom in geometries.items():
+            i = self.bearingIndex[fid]
+            if index is not None and not np.isnan(bounds[i, 0]):
+                # The entry is found by its previous bounding box
+                feat = QgsFeature(fid)
+                feat.setGeometry(QgsGeometry.fromRect(QgsRectangle(
+                    *bounds[i].tolist())))
+                index.deleteFeature(feat)
+            bounds[i] = geometryBounds(geom)
+            if index is not None and not np.isnan(bounds[i, 0]):
+                feat = QgsFeature(fid)
+                feat.setGeometry(geom)
+                index.insertFeature(feat)
+
+    def nearestObservation(self, point, radius):
+        """Shown observation whose point or line is the nearest to a point
+
+        The candidates are given by the spatial indexes, then their
+        exact distance to the point is computed.
+
+        Parameters
+        ----------
+        point : QgsPointXY
+            The point, in the coordinates of the layers
+        radius : float
+            Largest distance to the observation, in the units of the layers
+
+        Return
+        ------
+        fid : int or None
+            The id of the observation, None when there is none
+        """
+        if self.pointIndex is None:
+            return None
+        # The index of the lines is built again after the lines or the
+        # filter changed. It then only has the shown lines
+        if self.lineIndex is None:
+            self.lineIndex = buildIndex(self.layerLine)
+        x, y = point.x(), point.y()
+        rect = QgsRectangle(x - radius, y - radius, x + radius, y + radius)
+        fids = set(self.pointIndex.intersects(rect))
+        fids.update(self.lineIndex.intersects(rect))
+        fids.difference_update(self.hiddenFids)
+        if len(fids) == 0:
+            return None
+        fids = list(fids)
+        lon, lat, azi = self.bearings[[self.bearingIndex[fid]
+                                       for fid in fids]].T
+        latRes, lonRes = dstArray(lon, lat, azi, self.segmentLength)
+        # The line starts at the point, unless the azimuth is invalid
+        distances = np.fmin(segmentDistances(x, y, lon, lat, lonRes, latRes),
+                            np.hypot(lon - x, lat - y))
+        distances[np.isnan(distances)] = np.inf
+        nearest = np.argmin(distances)
+        if distances[nearest] > radius:
+            return None
+        return fids[nearest]
+
+    def rowBounds(self, indexes):
+        """Bounding boxes of the points and the lines of rows
+
+        Parameters
+        ----------
+        indexes : list of int
+            The positions of the rows in bearingFids
+
+        Return
+        ------
+        bounds : numpy.ndarray of float
+            The box (xmin, ymin, xmax, ymax) of each row, NaN when the row
+            has neither a point nor a line
+        """
+        points = self.pointBounds[indexes]
+        lines = self.lineBounds[indexes]
+        return np.concatenate([np.fmin(points[:, :2], lines[:, :2]),
+                               np.fmax(points[:, 2:], lines[:, 2:])],
+                              axis = 1)
+
+    def growVisibleBounds(self, indexes):
+        """Extend the visible extent with the boxes of shown rows"""
+        if self.visibleBounds is None or len(indexes) == 0:
+            return
+        self.visibleBounds = unionBounds(np.vstack(
+            [self.visibleBounds, self.rowBounds(indexes)]))
+
+    def shrinkVisibleBounds(self, indexes):
+        """Forget the visible extent when the boxes of rows that are no
+        longer shown touch its limits, so that it is computed again"""
+        if self.visibleBounds is None or len(indexes) == 0:
+            return
+        bounds = self.rowBounds(indexes)
+        if (bounds[:, :2] <= self.visibleBounds[:2]).any() or \
+           (bounds[:, 2:] >= self.visibleBounds[2:]).any():
+            self.visibleBounds = None
+
+    def visibleExtent(self):
+        """Extent of the shown points and lines in the CRS of the layers,
+        None when no feature is shown
+
+        It is only computed again from all the rows when a row at its
+        limits was hidden or moved (see shrinkVisibleBounds).
+        """
+        if self.visibleBounds is None:
+            hidden = np.isin(self.bearingFids,
+                             np.fromiter(self.hiddenFids, dtype = np.int64))
+            self.visibleBounds = unionBounds(
+                self.rowBounds(np.flatnonzero(~hidden)))
+        xMin, yMin, xMax, yMax = self.visibleBounds.tolist()
+        if xMin > xMax or yMin > yMax:
+            return None
+        return QgsRectangle(xMin, yMin, xMax, yMax)
+
+    def markDirty(self, rowIds):
+        """Indicate rows whose triangulation group may have changed"""
+        self.dirtyRows.update(rowIds)
+
+    def dirtyGroupRows(self):
+        """Ids of the dirty rows and of the rows of their current groups.
+        The new groups of all these rows must be given to
+        updateIntersections."""
+        rowIds = set(self.dirtyRows)
+        for rowId in self.dirtyRows:
+            groupId = self.groupOfRow.get(rowId)
+            if groupId is not None:
+                rowIds.update(self.rowsOfGroup[groupId])
+        return rowIds
+
+    def updateIntersections(self, groups):
+        """Rewrite only the intersections of the dirty triangulation groups
+
+        Parameters
+        ----------
+        groups : list of the triangulation groups containing the rows
+            given by dirtyGroupRows (see TrackingModel.triangulations)
+        """
+        if self.layerInter is None:
+            return
+        # Remove the previous groups of the impacted rows
+        rowIds = self.dirtyGroupRows()
+        for group in groups:
+            rowIds.update(group['ids'])
+        self.dirtyRows = set()
+        previousGroupIds = set(self.groupOfRow[rowId] for rowId in rowIds
+                               if rowId in self.groupOfRow)
+        for groupId in previousGroupIds:
+            for rowId in self.rowsOfGroup.pop(groupId):
+                del self.groupOfRow[rowId]
+        # Empty the features of the groups that disappeared
+        prov = self.layerInter.dataProvider()
+        emptyAttrs = {prov.fieldNameIndex('size'): None,
+                      prov.fieldNameIndex('residual'): None}
+        geometries = {groupId: QgsGeometry() for groupId in previousGroupIds}
+        attrs = {groupId: emptyAttrs for groupId in previousGroupIds}
+        geometries.update(self.computeIntersections(groups))
+        attrs.update(self.intersectionAttributes(groups))
+        with self.batch():
+            self.updateRowGeometry(self.layerInter, geometries)
+            self.changeAttributeValues(self.layerInter, attrs)
 
     def updateRowGeometry(self, layer, geometries):
         if layer is None:
             return
-        layer.startEditing()
-        for idRow, geom in geometries.items():
-            layer.changeGeometry(idRow, geom)
-        layer.commitChanges()
-        layer.updateExtents()
+        pending = self.pendingGeometries.setdefault(layer.id(), (layer, {}))
+        pending[1].update(geometries)
+        if self.batchDepth == 0:
+            self.flush()
 
     def makeLineGeometry(self, rowData):
         try:
@@ -224,6 +689,39 @@ class QgsController:
         except:
             return QgsGeometry()
 
+    def setBearings(self, rows):
+        """Keep the origin and the azimuth of each line (NaN when invalid)
+        for redrawing all of them at once."""
+        self.setBearingFids([row['id_observation'] for row in rows])
+        self.bearings = np.array([[toFloat(row[labels['X']]),
+                                   toFloat(row[labels['Y']]),
+                                   toFloat(row[labels['AZIMUT']])]
+                                  for row in rows]).reshape(-1, 3)
+
+    def setBearingFids(self, fids):
+        """Give the feature ids of the lines, in the order of the rows"""
+        self.bearingFids = np.array(fids, dtype = np.int64)
+        self.bearingIndex = {fid: i
+                             for i, fid in enumerate(self.bearingFids.tolist())}
+
+    def updateBearing(self, row):
+        index = self.bearingIndex.get(row['id_observation'])
+        if index is not None:
+            self.bearings[index] = [toFloat(row[labels['X']]),
+                                    toFloat(row[labels['Y']]),
+                                    toFloat(row[labels['AZIMUT']])]
+
+    def makeLineGeometries(self):
+        """Build the lines of all the bearings, in the order of bearingFids"""
+        lon, lat, azi = self.bearings.T
+        latRes, lonRes = dstArray(lon, lat, azi, self.segmentLength)
+        valid = np.isfinite(self.bearings).all(axis = 1)
+        return [QgsGeometry.fromPolyline([QgsPoint(x, y), QgsPoint(x2, y2)])
+                if ok else QgsGeometry()
+                for x, y, x2, y2, ok in zip(lon.tolist(), lat.tolist(),
+                                            lonRes.tolist(), latRes.tolist(),
+                                            valid.tolist())]
+
     def makePointGeometry(self, rowData):
         try:
             inX = rowData[labels['X']]
@@ -241,10 +739,27 @@ class QgsController:
 
         fieldIdx = self.layerPoint.dataProvider().fieldNameIndex('id')
         attrs = {row['id_observation']: {fieldIdx: row['id']} for row in array}
+        self.markDirty(attrs.keys())
 
-        self.changeAttributeValues(self.layerLine, attrs)
-        self.changeAttributeValues(self.layerPoint, attrs)
-        self.changeAttributeValues(self.layerInter, attrs)
+        with self.batch():
+            self.changeAttributeValues(self.layerLine, attrs)
+            self.changeAttributeValues(self.layerPoint, attrs)
+            self.changeAttributeValues(self.layerInter, attrs)
+
+    def setDateTime(self, array):
+        """Update the datetime attribute of the features of rows"""
+        if len(array) == 0 or self.layerPoint is None:
+            return
+
+        fieldIdx = self.layerPoint.dataProvider().fieldNameIndex('datetime')
+        attrs = {row['id_observation']: {fieldIdx: rowEpoch(row)}
+                 for row in array}
+        self.markDirty(attrs.keys())
+
+        with self.batch():
+            self.changeAttributeValues(self.layerLine, attrs)
+            self.changeAttributeValues(self.layerPoint, attrs)
+            self.changeAttributeValues(self.layerInter, attrs)
 
     def updateRenderer(self, idRend, indexes, size):
         if len(indexes) == 0:
@@ -269,61 +784,157 @@ class QgsController:
         return {cat.value(): cat.symbol().color()
                 for cat in self.idRendPoint.categories()}
 
-    def initFilter(self, layer):
-        """Initialize the filtering attribute to show all features (must be
-        called before setting the filtering rule to get the list of
-        feature ids).
+    def setFlags(self, fids, flags):
+        """Write the flags of the features whose flags changed
+
+        Parameters
+        ----------
+        fids : numpy.ndarray of int
+            The ids of the features
+        flags : numpy.ndarray of int
+            The flags of each feature (see TrackingModel.rowFlags)
         """
-        if layer is None:
+        if self.layerPoint is None:
             return
-
-        fieldIdx = layer.dataProvider().fieldNameIndex('filter')
-        fids = [feature.id() for feature in layer.getFeatures()]
-        attrs = {featureId: {fieldIdx: False} for featureId in fids}
-
-        self.changeAttributeValues(layer, attrs)
-
-    def setFilter(self, idRows, isFiltered):
-        if len(idRows) == 0 or self.layerPoint is None:
+        changed = np.flatnonzero(self.flagsOfFid[fids] != flags)
+        if len(changed) == 0:
             return
+        fids = fids[changed]
+        flags = flags[changed]
+        self.flagsOfFid[fids] = flags
+
+        fieldIdx = self.layerPoint.dataProvider().fieldNameIndex('flags')
+        attrs = {fid: {fieldIdx: flag}
+                 for fid, flag in zip(fids.tolist(), flags.tolist())}
+        with self.batch():
+            self.changeAttributeValues(self.layerLine, attrs)
+            self.changeAttributeValues(self.layerPoint, attrs)
+            self.changeAttributeValues(self.layerInter, attrs)
+            # The subset expression lists the flags of the features
+            self.pendingFilter = True
+
+    def setFilter(self, emitter, start, end, flags):
+        """Set the filter of all the layers at once
+
+        The filter is a subset expression on the id, flags and datetime
+        attributes of the features, so its length does not depend on
+        the number of features it hides, and changing it writes nothing.
 
-        # This assumes that the fieldIdx is the same in both layers
-        fieldIdx = self.layerPoint.dataProvider().fieldNameIndex('filter')
-        attrs = {featureId: {fieldIdx: isFiltered} for featureId in idRows}
-
-        self.changeAttributeValues(self.layerLine, attrs)
-        self.changeAttributeValues(self.layerPoint, attrs)
-        self.changeAttributeValues(self.layerInter, attrs)
+        Parameters
+        ----------
+        emitter : str
+            Keep only the features of this radioemitter, all of them when
+            None
+        start, end : int
+            Keep only the features whose datetime (in epoch seconds) is in
+            this interval, or is invalid. Not filtered when None
+        flags : int
+            Keep only the features having all these flags (see
+            TrackingModel.filterFlags)
+        """
+        if self.layerPoint is None:
+            return
+        criteria = (emitter, start, end, flags)
+        if criteria == self.filterCriteria:
+            return
+        self.filterCriteria = criteria
+        self.pendingFilter = True
+        if self.batchDepth == 0:
+            self.flush()
+
+    def filterSubsetString(self):
+        """Subset expression of the filter (see setFilter), in the
+        syntax of the provider of the layers"""
+        emitter, start, end, flags = self.filterCriteria
+        if self.layersInGeoPackage:
+            quote = sqlQuotedString
+        else:
+            quote = QgsExpression.quotedString
+        terms = []
+        if emitter is not None:
+            terms.append('"id" = %s' % quote(emitter))
+        bounds = []
+        if start is not None:
+            bounds.append('"datetime" >= %d' % start)
+        if end is not None:
+            bounds.append('"datetime" <= %d' % end)
+        if len(bounds) > 0:
+            terms.append('"datetime" IS NULL OR (%s)' % ' AND '.join(bounds))
+        if flags != 0:
+            # The few combinations of flags of the features which have
+            # all the filtered ones
+            values = np.unique(self.flagsOfFid[self.bearingFids])
+            kept = values[(values & flags) == flags]
+            if len(kept) == 0:
+                terms.append('0 = 1')
+            elif len(kept) < len(values):
+                terms.append('"flags" IN (%s)' %
+                              ','.join(str(value) for value in kept.tolist()))
+        return ' AND '.join('(%s)' % term for term in terms)
+
+    def updateFilter(self, shownIds, hiddenIds):
+        """Keep the features shown by the filter (see setFilter), to
+        compute the visible extent and to search the observations
+        """
+        if (len(shownIds) == 0 and len(hiddenIds) == 0) or \
+           self.layerPoint is None:
+            return
 
-        # If zoom set has not changed (autozoom), adjust the zoom
-        if self.autoZoom():
-            self.updateZoom()
+        # Update the visible extent with the features whose state changed
+        hiddenIds = set(hiddenIds)
+        newlyShown = self.hiddenFids.intersection(shownIds) - hiddenIds
+        newlyHidden = hiddenIds - self.hiddenFids
+        self.shrinkVisibleBounds([self.bearingIndex[fid]
+                                  for fid in newlyHidden])
+        self.growVisibleBounds([self.bearingIndex[fid]
+                                for fid in newlyShown])
+
+        self.hiddenFids.difference_update(shownIds)
+        self.hiddenFids.update(hiddenIds)
+        # Adjust the zoom if it has not changed (autozoom)
+        self.pendingZoom = True
+        if self.batchDepth == 0:
+            self.flush()
 
     def changeAttributeValues(self, layer, attrs):
         """Change the values of an attribute that can possibly impact the
         graphical output (filtering, renderer)"""
         if layer is None:
             return
-        layer.dataProvider().changeAttributeValues(attrs)
-        layer.triggerRepaint()
-        layer.updateExtents()
+        pending = self.pendingAttributes.setdefault(layer.id(), (layer, {}))[1]
+        for featureId, values in attrs.items():
+            pending.setdefault(featureId, {}).update(values)
+        if self.batchDepth == 0:
+            self.flush()
 
     def updateZoom(self):
         fullExtent = self.updateFullExtent()
+        if fullExtent is None:
+            return
         # Does not zoom to full extent because it does not integrate well
         # with a basemap
         iface.mapCanvas().zoomToFeatureExtent(fullExtent)
         self.currExtent = iface.mapCanvas().extent()
 
     def updateFullExtent(self):
-        fullExtent = self.layerPoint.extent()
-        fullExtent.combineExtentWith(self.layerLine.extent())
+        """Extent of the shown features in the project CRS"""
+        extent = self.visibleExtent()
+        if extent is None:
+            return None
         # Assumes that the CRS is the same in both layers
-        sourceCrs = self.layerPoint.crs()
-        destCrs = QgsProject.instance().crs()
-        xform = QgsCoordinateTransform(sourceCrs, destCrs, QgsProject.instance())
-        geom = QgsGeometry.fromRect(fullExtent)
-        return xform.transform(fullExtent)
+        xform = self.transform(self.layerPoint.crs(),
+                               QgsProject.instance().crs())
+        return xform.transform(extent)
+
+    def transform(self, sourceCrs, destCrs):
+        """Coordinate transform between two CRSs, kept for the next calls"""
+        key = (sourceCrs.toWkt(), destCrs.toWkt())
+        xform = self.transforms.get(key)
+        if xform is None:
+            xform = QgsCoordinateTransform(sourceCrs, destCrs,
+                                           QgsProject.instance())
+            self.transforms[key] = xform
+        return xform
 
     def autoZoom(self):
         if self.currExtent is None:
@@ -334,6 +945,17 @@ class QgsController:
 
     def setSegmentLength(self, length):
         self.segmentLength = length
+        if self.layerLine is None:
+            return
+        geometries = self.makeLineGeometries()
+        self.lineBounds = lineBounds(self.bearings, self.segmentLength)
+        # The index of the lines is built again only when it is used, not
+        # for every step of the length (see nearestObservation)
+        self.lineIndex = None
+        # All the lines changed
+        self.visibleBounds = None
+        geometries = dict(zip(self.bearingFids.tolist(), geometries))
+        self.updateRowGeometry(self.layerLine, geometries)
 
     def setEPSG4326(self):
         self.CRS = QgsCoordinateReferenceSystem('epsg:4326')
@@ -362,26 +984,93 @@ class QgsController:
         self.layerInterVisible = not self.layerInterVisible
         iface.layerTreeView().setLayerVisible(self.layerInter, self.layerInterVisible)
 
+def geometryBounds(geom):
+    """Bounding box (xmin, ymin, xmax, ymax) of a geometry, NaN when empty"""
+    if geom.isEmpty():
+        return [nan] * 4
+    box = geom.boundingBox()
+    return [box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()]
+
+def buildIndex(layer):
+    """Spatial index of the non empty geometries of a layer, bulk loaded
+    by QGIS from the features of the layer (only the ones kept by its
+    subset string)"""
+    request = QgsFeatureRequest().setNoAttributes()
+    return QgsSpatialIndex(layer.getFeatures(request))
+
+def pointBounds(bearings):
+    """Bounding boxes of the points of bearings (see
+    QgsController.setBearings), NaN when the position is invalid"""
+    lon, lat = bearings[:, 0], bearings[:, 1]
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    bounds = np.column_stack([lon, lat, lon, lat])
+    bounds[~valid] = nan
+    return bounds
+
+def lineBounds(bearings, segmentLength):
+    """Bounding boxes of the lines of bearings (see
+    QgsController.setBearings), NaN when the bearing is invalid"""
+    lon, lat, azi = bearings.T
+    latRes, lonRes = dstArray(lon, lat, azi, segmentLength)
+    valid = np.isfinite(bearings).all(axis = 1)
+    bounds = np.column_stack([np.minimum(lon, lonRes),
+                              np.minimum(lat, latRes),
+                              np.maximum(lon, lonRes),
+                              np.maximum(lat, latRes)])
+    bounds[~valid] = nan
+    return bounds
+
+def renumberRows(rows, groups, fids):
+    """Give new ids to the rows and to the rows of the triangulation groups
+
+    Parameters
+    ----------
+    rows : list of TrackingModel items
+    groups : list of triangulation groups (see
+        TrackingModel.triangulations)
+    fids : numpy.ndarray of int
+        The new id of each row, in the same order
+
+    Return
+    ------
+    rows, groups : list
+        The renumbered copies, or the given lists when the ids are unchanged
     """
-    Fonctionnalité inspiré du lien ci-dessous :
-    http://www.movable-type.co.uk/scripts/latlong.html
-	"""
-
-def dst(longitude, latitude, azimut, distance):
-    """
-        Calcul du nouveau point en fonction des paramètres d'un point (longitude, latitude, azimut, distance)
-    """
-    # Transformation des valeurs de degré en radian
-    rLat = radians(latitude)
-    rLong = radians(longitude)
-    rAzimut = radians(azimut)
-    quotient = distance/RADIAN_DE_LA_TERRE
-
-    # Calcul de la latitude et de la longitude du second point
-    rLat2 = asin(sin(rLat) * cos(quotient) + cos(rLat) * sin(quotient) * cos(rAzimut))
-    param1 = cos(quotient) - sin(rLat) * sin(rLat2)
-    param2 = sin(rAzimut) * sin(quotient) * cos(rLat)
-    rLong2 = rLong + atan2(param2,param1)
-
-    # Transformation des valeurs de radian en degré
-    return degrees(rLat2), degrees(rLong2)
+    newIds = dict(zip([row['id_observation'] for row in rows], fids.tolist()))
+    if all(rowId == fid for rowId, fid in newIds.items()):
+        return rows, groups
+    rows = [dict(row, id_observation = newIds[row['id_observation']])
+            for row in rows]
+    groups = [dict(group, ids = [newIds[rowId] for rowId in group['ids']])
+              for group in groups]
+    return rows, groups
+
+def rowEpoch(row):
+    """Datetime of a row in epoch seconds, None when invalid"""
+    value = row['datetime']
+    if isinstance(value, QDateTime):
+        return dateTimeToEpoch(value)
+    return None
+
+def indexFields(layer, names):
+    """Create the attribute indexes of fields when the provider can"""
+    prov = layer.dataProvider()
+    if not prov.capabilities() & QgsVectorDataProvider.CreateAttributeIndex:
+        return
+    for name in names:
+        prov.createAttributeIndex(prov.fieldNameIndex(name))
+
+def sqlQuotedString(value):
+    """String literal of a value in SQL"""
+    return "'%s'" % value.replace("'", "''")
+
+def unionBounds(bounds):
+    """Box (xmin, ymin, xmax, ymax) containing boxes, ignoring the NaN
+    values. It is inverted (xmin > xmax) when there is no box."""
+    return np.concatenate([
+        np.fmin.reduce(bounds[:, :2], axis = 0, initial = np.inf),
+        np.fmax.reduce(bounds[:, 2:], axis = 0, initial = -np.inf)])
+
+def toFloat(value):
+    """Value of a valid coordinate or azimuth, NaN otherwise"""
+    return value if isinstance(value, float) else nan
@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import unittest
+
+import numpy as np
+
+from qgis.PyQt.QtCore import QDate, QTime, QDateTime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from csv_utils import DateTimeParser, DATETIME_FORMATS, dateTimeToEpoch
+from csv_utils import detectDateTimeFormat
+
+def formatFields(datetimeFormat, fields):
+    """Texts of datetime fields (year, month, day, hour, minute, second)
+    in a format"""
+    return [datetimeFormat.replace('yyyy', year).replace('MM', month)
+            .replace('M', month).replace('dd', day).replace('d', day)
+            .replace('hh', hour).replace('mm', minute).replace('ss', second)
+            for year, month, day, hour, minute, second in fields]
+
+class TestDateTimeParser(unittest.TestCase):
+    def assertSameAsQt(self, datetimeFormat, contents):
+        """The parser gives the same datetimes as QDateTime.fromString"""
+        epochs, valid = DateTimeParser(datetimeFormat).parse(contents)
+        for content, epoch, ok in zip(contents, epochs.tolist(),
+                                      valid.tolist()):
+            expected = QDateTime.fromString(content, datetimeFormat)
+            self.assertEqual(ok, expected.isValid(),
+                             '%r with %s' % (content, datetimeFormat))
+            if ok:
+                self.assertEqual(epoch, dateTimeToEpoch(expected),
+                                 '%r with %s' % (content, datetimeFormat))
+
+    def test_random_datetimes(self):
+        rng = np.random.default_rng(0)
+        datetimes = [QDateTime(QDate(int(year), int(month), int(day)),
+                               QTime(int(hour), int(minute), int(second)))
+                     for year, month, day, hour, minute, second in zip(
+                         rng.integers(1900, 2100, 500),
+                         rng.integers(1, 13, 500), rng.integers(1, 29, 500),
+                         rng.integers(0, 24, 500), rng.integers(0, 60, 500),
+                         rng.integers(0, 60, 500))]
+        for datetimeFormat in DATETIME_FORMATS:
+            self.assertSameAsQt(datetimeFormat,
+                                [datetime.toString(datetimeFormat)
+                                 for datetime in datetimes])
+
+    def test_special_datetimes(self):
+        # Leap days, out of range fields, empty and malformed texts
+        fields = [('2020', '02', '29', '10', '11', '12'),
+                  ('2000', '02', '29', '10', '11', '12'),
+                  ('2019', '02', '29', '10', '11', '12'),
+                  ('1900', '02', '29', '10', '11', '12'),
+                  ('2019', '04', '31', '10', '11', '12'),
+                  ('2019', '12', '31', '23', '59', '59'),
+                  ('2019', '13', '01', '10', '11', '12'),
+                  ('2019', '00', '01', '10', '11', '12'),
+                  ('2019', '01', '00', '10', '11', '12'),
+                  ('2019', '01', '32', '10', '11', '12'),
+                  ('2019', '01', '05', '24', '11', '12'),
+                  ('2019', '01', '05', '10', '60', '12'),
+                  ('2019', '01', '05', '10', '11', '60'),
+                  ('2019', '1', '5', '10', '11', '12'),
+                  ('2019', '01', '05', '1', '2', '3'),
+                  ('2019', '001', '05', '10', '11', '12'),
+                  ('201', '01', '05', '10', '11', '12'),
+                  ('٢٠٢٠', '01', '05', '10', '11', '12'),
+                  ('2019', '01', '05', '10', '11', '1x')]
+        for datetimeFormat in DATETIME_FORMATS:
+            contents = ['', ' ', 'text', '2019-01-05 10:11:12 ']
+            contents += formatFields(datetimeFormat, fields)
+            self.assertSameAsQt(datetimeFormat, contents)
+
+    def test_daylight_saving_time(self):
+        # The local times skipped when the daylight saving time starts are
+        # invalid, like with QDateTime
+        timeZone = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/Paris'
+        time.tzset()
+        try:
+            self.assertFalse(QDateTime(QDate(2020, 3, 29),
+                                       QTime(2, 30)).isValid())
+            fields = [('2020', '03', '29', '02', '30', '00'),
+                      ('2020', '03', '29', '02', '00', '00'),
+                      ('2020', '03', '29', '02', '59', '59'),
+                      ('2020', '03', '29', '01', '59', '59'),
+                      ('2020', '03', '29', '03', '00', '00'),
+                      ('2020', '10', '25', '02', '30', '00')]
+            for datetimeFormat in DATETIME_FORMATS:
+                contents = formatFields(datetimeFormat, fields)
+                valid = DateTimeParser(datetimeFormat).parse(contents)[1]
+                self.assertEqual(valid.tolist(),
+                                 [False, False, False, True, True, True])
+                self.assertSameAsQt(datetimeFormat, contents)
+        finally:
+            if timeZone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = timeZone
+            time.tzset()
+
+class TestDetectDateTimeFormat(unittest.TestCase):
+    DEFAULT = 'yyyy-MM-dd hh:mm:ss'
+    DAY_MONTH = 'd/M/yyyy hh:mm:ss'
+    MONTH_DAY = 'M/d/yyyy hh:mm:ss'
+
+    def test_day_above_12(self):
+        # Only the days above 12 tell the order of the day and the month
+        self.assertEqual(detectDateTimeFormat(
+            ['5/3/2020 10:11:12', '25/3/2020 10:11:12', '',
+             '1/2/2020 10:11:12'],
+            self.DEFAULT), self.DAY_MONTH)
+        self.assertEqual(detectDateTimeFormat(
+            ['5/3/2020 10:11:12', '3/25/2020 10:11:12', '',
+             '1/2/2020 10:11:12'],
+            self.DEFAULT), self.MONTH_DAY)
+        # The format parsing the most datetimes wins over the other one
+        self.assertEqual(detectDateTimeFormat(
+            ['25/3/2020 10:11:12', '26/3/2020 10:11:12', '3/27/2020 10:11:12'],
+            self.MONTH_DAY), self.DAY_MONTH)
+
+    def test_tie_keeps_current_format(self):
+        contents = ['5/3/2020 10:11:12', '1/2/2020 10:11:12']
+        self.assertEqual(detectDateTimeFormat(contents, self.MONTH_DAY),
+                         self.MONTH_DAY)
+        self.assertEqual(detectDateTimeFormat(contents, self.DAY_MONTH),
+                         self.DAY_MONTH)
+        contents = ['25/3/2020 10:11:12', '3/25/2020 10:11:12']
+        self.assertEqual(detectDateTimeFormat(contents, self.MONTH_DAY),
+                         self.MONTH_DAY)
+
+    def test_no_valid_datetime(self):
+        for contents in [[], ['', ''], ['', 'text', '2020-13-01 10:11:12',
+                                        '32/1/2020 10:11:12']]:
+            self.assertEqual(detectDateTimeFormat(contents, self.MONTH_DAY),
+                             self.MONTH_DAY)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from geo_utils import dst, dstArray, bearingPairsIntersection
+from geo_utils import segmentDistances, bearingsIntersection
+
+class TestDstArrayFunction(unittest.TestCase):
+    def test_dst_array(self):
+        rng = np.random.default_rng(0)
+        lon = rng.uniform(-180, 180, 1000)
+        lat = rng.uniform(-89, 89, 1000)
+        azi = rng.uniform(0, 360, 1000)
+        latRes, lonRes = dstArray(lon, lat, azi, 2.5)
+        for i in range(len(lon)):
+            (test_lat, test_lon) = dst(lon[i], lat[i], azi[i], 2.5)
+            self.assertAlmostEqual(latRes[i], test_lat, places=9)
+            self.assertAlmostEqual(lonRes[i], test_lon, places=9)
+
+    def test_dst_array_invalid(self):
+        latRes, lonRes = dstArray(np.array([5.5, np.nan]),
+                                  np.array([46.6, 46.6]),
+                                  np.array([np.nan, 45.]), 1)
+        self.assertTrue(np.isnan(latRes[0]))
+        self.assertTrue(np.isnan(lonRes).all())
+
+class TestBearingPairsIntersectionFunction(unittest.TestCase):
+    def test_intersection(self):
+        # Bearings of a target at 46.6N 5.5E from two antennas
+        latRes, lonRes = bearingPairsIntersection(
+            np.array([46.58, 46.6]), np.array([5.48, 5.45]),
+            np.array([34.49014, 89.98184]),
+            np.array([46.62, 46.61]), np.array([5.47, 5.53]),
+            np.array([134.13017, 244.12897]))
+        np.testing.assert_allclose(latRes, [46.6, 46.6], atol=1e-4)
+        np.testing.assert_allclose(lonRes, [5.5, 5.5], atol=1e-4)
+
+    def test_no_intersection(self):
+        # Diverging, then parallel bearings
+        latRes, lonRes = bearingPairsIntersection(
+            np.array([46.58, 46.6]), np.array([5.48, 5.45]),
+            np.array([214.49014, 0.]),
+            np.array([46.62, 46.6]), np.array([5.47, 5.46]),
+            np.array([134.13017, 0.]))
+        self.assertTrue(np.isnan(latRes).all())
+        self.assertTrue(np.isnan(lonRes).all())
+
+class TestBearingsIntersectionFunction(unittest.TestCase):
+    # Bearings of a target at 46.6N 5.5E from three antennas
+    LATITUDES = np.array([46.58, 46.6, 46.62])
+    LONGITUDES = np.array([5.48, 5.45, 5.53])
+    AZIMUTHS = np.array([34.49014, 89.98184, 225.86983])
+
+    def test_intersection(self):
+        lat, lon, residual = bearingsIntersection(
+            np.zeros(3, dtype = int), self.LATITUDES, self.LONGITUDES,
+            self.AZIMUTHS, 1)
+        np.testing.assert_allclose([lat[0], lon[0]], [46.6, 5.5], atol=1e-4)
+        self.assertLess(residual[0], 1e-3)
+
+    def test_behind(self):
+        # Reversed bearings cross behind all the antennas
+        lat, lon, residual = bearingsIntersection(
+            np.zeros(3, dtype = int), self.LATITUDES, self.LONGITUDES,
+            (self.AZIMUTHS + 180) % 360, 1)
+        self.assertTrue(np.isnan(lat[0]))
+        self.assertTrue(np.isnan(lon[0]))
+        self.assertTrue(np.isnan(residual[0]))
+
+    def test_antimeridian(self):
+        # Same geometry moved across the antimeridian
+        longitudes = self.LONGITUDES + 174.5
+        longitudes[1] -= 360
+        lat, lon, residual = bearingsIntersection(
+            np.zeros(3, dtype = int), self.LATITUDES, longitudes,
+            self.AZIMUTHS, 1)
+        self.assertAlmostEqual(lat[0], 46.6, places=4)
+        # 180 and -180 are the same meridian
+        self.assertAlmostEqual((lon[0] + 360) % 360, 180., places=4)
+        self.assertLess(residual[0], 1e-3)
+
+class TestSegmentDistancesFunction(unittest.TestCase):
+    def test_segment_distances(self):
+        # Projection inside, before the start, after the end, degenerate
+        # segment and invalid end
+        distances = segmentDistances(1., 1.,
+                                     np.array([0., 2., -3., 1., 0.]),
+                                     np.array([0., 0., 0., 4., 0.]),
+                                     np.array([2., 4., -1., 1., np.nan]),
+                                     np.array([0., 0., 0., 4., 0.]))
+        np.testing.assert_allclose(distances[:4], [1., np.sqrt(2), np.sqrt(5),
+                                                   3.])
+        self.assertTrue(np.isnan(distances[4]))
+
+if __name__ == '__main__':
+    unittest.main()
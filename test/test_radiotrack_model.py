@@ -0,0 +1,118 @@
+import importlib
+import os
+import sys
+import unittest
+
+import numpy as np
+
+from qgis.PyQt.QtCore import Qt, QDateTime
+
+# The plugin modules use relative imports, so they are imported from
+# the plugin package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(ROOT))
+radiotrack_model = importlib.import_module(os.path.basename(ROOT) +
+                                           '.radiotrack_model')
+TrackingModel = radiotrack_model.TrackingModel
+
+HEADERS = ['id', 'datetime', 'lat', 'lon', 'azi']
+EMITTERS = ['a', 'b', 'c']
+# Datetimes of the rows, in a short interval so that they often are
+# within the tolerance of each other
+FIRST_DATETIME = QDateTime.fromString('2020-01-15 10:00:00',
+                                      'yyyy-MM-dd hh:mm:ss')
+
+def randomDateTime(rng):
+    if rng.random() < 0.1:
+        return 'invalid'
+    return FIRST_DATETIME.addSecs(int(rng.integers(0, 1200))) \
+        .toString('yyyy-MM-dd hh:mm:ss')
+
+def randomLine(rng):
+    return [str(rng.choice(EMITTERS)), randomDateTime(rng),
+            str(rng.uniform(46, 47)), str(rng.uniform(5, 6)),
+            str(rng.uniform(0, 360))]
+
+def referenceGroups(model):
+    """Triangulation groups of the model found by comparing all the pairs
+    of rows: the sets of row ids linked by chains of rows of the same
+    emitter within the tolerance"""
+    tolerance = model.triangulationDetector.tolerance
+    emitters = model.rawColumn(model.schema.idIndex)
+    dates, valid = model.dateTimes()
+    nbRows = model.rowCount()
+    component = list(range(nbRows))
+    def find(row):
+        while component[row] != row:
+            row = component[row]
+        return row
+    for i in range(nbRows):
+        for j in range(i + 1, nbRows):
+            if valid[i] and valid[j] and emitters[i] == emitters[j] and \
+               abs(int(dates[i]) - int(dates[j])) <= tolerance:
+                component[find(i)] = find(j)
+    groups = {}
+    for row in range(nbRows):
+        groups.setdefault(find(row), set()).add(int(model.fids[row]))
+    return [group for group in groups.values() if len(group) >= 2]
+
+def sortedGroups(groups):
+    return sorted(sorted(int(rowId) for rowId in group) for group in groups)
+
+class TestTriangulationDetector(unittest.TestCase):
+    def assertMatchesReference(self, model, rng):
+        groups = referenceGroups(model)
+        triangulated = set().union(*groups)
+        for row in range(model.rowCount()):
+            expected = int(model.fids[row]) in triangulated
+            self.assertEqual(model.triangulated(row), expected)
+            self.assertEqual(bool(model.rowState[row] &
+                                  model.STATE_TRIANGULATED), expected)
+            self.assertEqual(bool(model.rowState[row] &
+                                  model.STATE_INVALID),
+                             not model.valid(row))
+        detector = model.triangulationDetector
+        self.assertEqual(sortedGroups(detector.triangulationGroups()),
+                         sortedGroups(groups))
+        self.assertEqual(sortedGroups(group['ids'] for group in
+                                      model.triangulations()),
+                         sortedGroups(groups))
+        # Groups of some rows only
+        rowIds = set(rng.choice(model.fids, 10).tolist())
+        self.assertEqual(sortedGroups(detector.triangulationGroups(rowIds)),
+                         sortedGroups(group for group in groups
+                                      if not group.isdisjoint(rowIds)))
+
+    def test_random_edits(self):
+        rng = np.random.default_rng(0)
+        model = TrackingModel(None)
+        model.setTriangulationTolerance(30)
+        model.initModel(HEADERS)
+        for chunk in range(3):
+            model.appendRows([randomLine(rng) for i in range(60)])
+            self.assertMatchesReference(model, rng)
+
+        schema = model.schema
+        for step in range(100):
+            row = int(rng.integers(model.rowCount()))
+            if rng.random() < 0.5:
+                index = model.index(row, schema.idIndex)
+                model.setData(index, str(rng.choice(EMITTERS)), Qt.EditRole)
+            else:
+                index = model.index(row, schema.dateIndex)
+                model.setData(index, randomDateTime(rng), Qt.EditRole)
+            if step % 10 == 0:
+                self.assertMatchesReference(model, rng)
+        self.assertMatchesReference(model, rng)
+
+        for tolerance in [0, 5, 120, 60, 60, 1, 300]:
+            model.setTriangulationTolerance(tolerance)
+            self.assertMatchesReference(model, rng)
+
+        # New ids, such as the ones of the features
+        rows = np.arange(model.rowCount())
+        model.setIds(rows, rng.permutation(len(rows)) + 100)
+        self.assertMatchesReference(model, rng)
+
+if __name__ == '__main__':
+    unittest.main()